@@ -3,84 +3,96 @@ import time
 # TODO: Write your code here!
 # Use robot.motors() to move
 # Use robot.left_sonar() and robot.right_sonar() to sense obstacles
-grid = []
 x = 8
 
 def motorsAndWait(Left,Right,Seconds):
     robot.motors(left=Left,right=Right,seconds=Seconds)
     time.sleep(abs(Seconds))
 import numpy as np
-for i in range(0,x):
-    grid.append("o" * int(x))
+from planner import OccupancyGrid, DStarLite
+from motion_plan import normalize_angle, spin_segment, turn_weighted_path, straight_runs
+from mapping import OccupancyMap
+grid = OccupancyGrid(x, x)
+cellSize = 12 # cm, how far forward() drives for each cell
 where = (0,0)
 goal = (3,3)
 direction = 0
-def createMap():
-    mapping = grid.copy()
-    for i in range(len(grid)):
-        for j in range(len(grid[i])):
-            mapping[i] = mapping[i][:j] + str(np.abs(j - goal[0]) + np.abs(i-goal[1])) + mapping[i][j+1:]
-    return(mapping)
 def sonarScan():
-    if(robot.right_sonar()>0):
-        return(False)
-    else:
-        return(True)
-def forward(helper):
-    # put whatever forward code here
-    motorsAndWait(FORWARD,FORWARD,2)
+    # how many cells ahead are clear (the robot faces them after turning)
+    left = robot.left_sonar()
+    distance = robot.right_sonar()
+    # remember what both sonars saw, from where the robot thinks it is
+    seen.update_sonars(robot.odometry.pose, left, distance)
+    if(distance == float("inf")):
+        return(x)
+    return(int(distance // cellSize))
+def forward(helper,cells):
+    # drive straight through all the cells in one go
+    # robot.cm_per_second comes from calibrate.py if the robot has been calibrated
+    motorsAndWait(FORWARD,FORWARD,cellSize * cells / robot.cm_per_second)
     global where
     where = helper
     #where = (int(where[0]+np.round(np.sin((direction*np.pi)/180))),int(where[1]+np.round(np.cos((direction*np.pi)/180))))
     print(where)
 end = False
-currentMap = createMap()
-print(currentMap)
+# cells blocked because of the map (not by sonarScan), so they can be let go again
+seenBlocked = set()
+def blockSeen():
+    # block the cells the sonars have seen something in, so the planner goes around them
+    # one echo only gets a cell to 0.7, so it takes at least two before it counts (one could be noise)
+    occupied = seen.occupancy_grid(threshold=0.8).blocked
+    for cellY, cellX in np.argwhere(occupied & ~grid.blocked):
+        cell = (int(cellX), int(cellY))
+        if(cell != tuple(where) and cell != goal):
+            planner.block(cell)
+            seenBlocked.add(cell)
+    # and free the ones later readings went through
+    for cell in list(seenBlocked):
+        if(not occupied[cell[1], cell[0]]):
+            planner.unblock(cell)
+            seenBlocked.remove(cell)
 def angleCalculate(start,destination):
-    rotate(start-destination)
+    # turn the short way round (-90 instead of 270)
+    rotate(normalize_angle(destination-start))
 def rotate(angle):
-    angleInSeconds = angle/(0.98 * 60)
-    # angle = 0.98 * 60 * seconds
-    #seconds = angle/(0.98 * 60)
-    motorsAndWait(BACKWARD,FORWARD,angleInSeconds)
+    # angle = robot.degrees_per_second * seconds
+    spin = spin_segment(angle,robot.degrees_per_second)
+    if(spin != None):
+        motorsAndWait(spin[0],spin[1],spin[2])
     global direction
-    direction = direction + angle
+    direction = (direction + angle) % 360
 where = [2,3]
+# what the sonars have seen, with the robot starting in the middle of cell where (odometry starts at 0, 0)
+seen = OccupancyMap(x, x, cell_cm=cellSize, origin=(-(where[0] + 0.5) * cellSize, -(where[1] + 0.5) * cellSize))
+# keeps the moves to the goal from each cell, and only fixes the ones that change when a cell gets blocked
+planner = DStarLite(grid, where, goal)
 testing = (int(where[0]+np.round(np.sin((direction*np.pi)/180))),int(where[1]+np.round(np.cos((direction*np.pi)/180))))
 while end == False:
-    values = []
-    value = [100000,"imposible",""]
-    for p in [(1,0),(-1,0),(0,1),(0,-1)]:
-        whereTo = np.array(where) + np.array(p)
-        whereTo = [int(whereTo[0]),int(whereTo[1])]
-        print("the coords" + str(whereTo))
-        if(whereTo[0] < 8 and whereTo[1] < 8 and whereTo[0] > -1 and whereTo[1] > -1):
-            print("coord " + str((p[0],p[1])) + ". Value: " + str(value[0]) + ". Map" + str(int(currentMap[whereTo[1]][whereTo[0]])))
-            if(value[0] > int(currentMap[whereTo[1]][whereTo[0]])):
-                value[0] = int(currentMap[whereTo[1]][whereTo[0]])
-                value[2] = whereTo
-                if(p == (1,0)):
-                    value[1] = 0
-                    print(p)
-                elif(p==(0,1)):
-                    value[1] = 90
-                elif(p==(-1,0)):
-                    value[1] = 180
-                elif(p==(0,-1)):
-                    value[1] = 270
-                else:
-                    raise Exception("invalid list itterator value")
-                #value[1] = round(180 * np.atan2(p[1],p[0])/np.pi)
-                print("angle" + str(value[1]))
-            values.append([currentMap[whereTo[1]][whereTo[0]],direction])
-    if(value[1] == "imposible"):
-        print(value)
+    if(planner.next_cell() == None):
         raise Exception("no space to move!")
-    angleCalculate(direction,value[1])
-    forward(value[2])
+    # quickest way to the goal from here, counting the time spent turning
+    # (D* Lite's distances guide it, Manhattan distance for cells it hasn't searched)
+    path = turn_weighted_path(grid, where, goal, direction, cellSize / robot.cm_per_second,
+                              robot.degrees_per_second, moves_to_goal=planner.distance)
+    if(path == None):
+        raise Exception("no space to move!")
+    # only the first straight line, the sonar might see something on the way
+    heading, cells = straight_runs(path)[0]
+    print("heading " + str(heading) + " for " + str(cells) + " cells")
+    angleCalculate(direction,heading)
+    clear = sonarScan()
+    blockSeen()
+    if(clear < cells):
+        # something in the way, mark it and plan around it
+        print("blocked" + str(list(path[clear + 1])))
+        planner.block(path[clear + 1])
+    if(clear == 0):
+        continue
+    steps = min(clear, cells)
+    forward(list(path[steps]),steps)
+    planner.move_to(where)
     print("moved" + str(where))
-    currentMap = createMap()
     if(where == [goal[0],goal[1]]):
         end = True
 # When you're done, close the simulator
-robot.exit()
\ No newline at end of file
+robot.exit()
@@ -0,0 +1,428 @@
+"""Simulator benchmarks
+
+Run with:
+    python benchmark.py
+    python benchmark.py --only physics sonars --output results.json
+    python benchmark.py --compare results.json
+
+Every benchmark prints its results and returns them as a dict. --output
+saves them all to a JSON file, and --compare prints how each number
+changed since an earlier file.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+# Windows for the real time benchmarks aren't shown
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from simulator import Robot, SimulatorDriver, Obstacle, Box, Vector, FORWARD, BACKWARD
+from raycast import SegmentGrid
+from planner import OccupancyGrid, bfs_path, distance_field
+from mapping import OccupancyMap
+from motion_plan import turn_weighted_path, path_segments, normalize_angle, spin_segment, MOVE_HEADINGS
+
+def time_per_call(function, repeats):
+    """Average wall time of one call to function, in seconds"""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+def random_obstacles(n, rng):
+    """n small obstacles at random positions and headings inside the arena"""
+    return [
+        Obstacle(rng.uniform(-950, 950), rng.uniform(-450, 450),
+                 rng.uniform(10, 60), rng.uniform(10, 60), rng.uniform(0, 360))
+        for _ in range(n)
+    ]
+
+def bench_sonar_obstacles(counts=(5, 100, 10000), repeats=2000):
+    """Cost of one sonar reading with different numbers of obstacles
+
+    Compares the grid index against testing every obstacle edge (one big cell).
+    """
+    rng = random.Random(0)
+    driver = SimulatorDriver(headless=True)
+    driver.heading = 37
+    print("obstacles | indexed (us/reading) | every edge (us/reading)")
+    results = {}
+    for n in counts:
+        driver.set_obstacles(random_obstacles(n, rng))
+        indexed = time_per_call(driver.left_sonar, repeats)
+
+        index = driver.obstacle_index
+        driver.obstacle_index = SegmentGrid(
+            index.segments, (index.min_x, index.min_y, index.max_x, index.max_y), cell_size=float("inf")
+        )
+        every_edge = time_per_call(driver.left_sonar, max(1, repeats * 5 // n))
+        driver.obstacle_index = index
+
+        print(f"{n:9} | {indexed * 1e6:20.1f} | {every_edge * 1e6:23.1f}")
+        results[f"{n} obstacles"] = {"indexed_us": indexed * 1e6, "every_edge_us": every_edge * 1e6}
+    return results
+
+def legacy_crash_at(driver, x, y, heading):
+    """Wall crash check the way it worked before RobotGeometry (new Box and Points every call)"""
+    for corner in Box(x, y, driver.robot_width, driver.robot_height, heading).corners().values():
+        if (corner.x > driver.max_x_box or corner.x < driver.min_x_box or
+                corner.y > driver.max_y_box or corner.y < driver.min_y_box):
+            return True
+    return False
+
+def legacy_sonar_positions(driver):
+    """Sonar positions the way they worked before RobotGeometry"""
+    front_right_corner, front_left_corner = driver._get_robot_box().front_edge()
+    front_edge = Vector.from_points(front_left_corner, front_right_corner)
+    left = front_left_corner + Vector(driver.sonar_inset, front_edge.theta).to_point()
+    right = front_right_corner + Vector(driver.sonar_inset, front_edge.theta + 180).to_point()
+    return left, right
+
+def bench_geometry(frames=20000):
+    """Frames per second of a spinning robot (position update + crash check),
+    and sonar positions per second, with Box objects (before) and RobotGeometry (after)"""
+    driver = SimulatorDriver(headless=True)
+
+    def spin(crash_at):
+        def run():
+            driver._update_position(FORWARD, BACKWARD)
+            crash_at(driver.x, driver.y, driver.heading)
+        return run
+
+    frames_before = time_per_call(spin(lambda x, y, heading: legacy_crash_at(driver, x, y, heading)), frames)
+    frames_after = time_per_call(spin(driver._crash_at), frames)
+    print(f"frames/s:          before {1 / frames_before:9.0f} | after {1 / frames_after:9.0f}")
+
+    sonars_before = time_per_call(lambda: legacy_sonar_positions(driver), frames)
+    sonars_after = time_per_call(driver._get_sonar_positions, frames)
+    print(f"sonar positions/s: before {1 / sonars_before:9.0f} | after {1 / sonars_after:9.0f}")
+    return {
+        "boxes_frames_per_s": 1 / frames_before, "geometry_frames_per_s": 1 / frames_after,
+        "boxes_sonar_positions_per_s": 1 / sonars_before, "geometry_sonar_positions_per_s": 1 / sonars_after,
+    }
+
+def maze_route(start=(0, 0), goal=(3, 3), size=8):
+    """Cells visited by MazeSolverRecent.py's greedy walk from start to goal (an empty maze)"""
+    route = []
+    where = start
+    while where != goal:
+        neighbours = [(where[0] + dx, where[1] + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))]
+        neighbours = [cell for cell in neighbours if 0 <= cell[0] < size and 0 <= cell[1] < size]
+        where = min(neighbours, key=lambda cell: abs(cell[0] - goal[0]) + abs(cell[1] - goal[1]))
+        route.append(where)
+    return route
+
+def bench_maze_mission(time_scale=20, cell_cm=12):
+    """Total mission time for the maze route, in real robot seconds
+
+    Runs the route in the simulator at time_scale times real time, once with
+    a motors() call for each command and once with run_trajectory(). Both
+    are paced the same way (by the simulator's clock, no extra sleeps) and
+    timed with the same clock: wall-clock time times time_scale, i.e. how
+    long the mission would take at real speed. The difference is what
+    stopping and restarting between commands costs.
+    """
+    def mission(run):
+        robot = Robot(headless=False)
+        robot.driver.time_scale = time_scale
+        # Few enough redraws per second that pygame's millisecond clock keeps good time
+        robot.driver.render_fps = 10
+        segments = robot.waypoint_segments([(x * cell_cm, y * cell_cm) for x, y in maze_route()])
+        start = time.perf_counter()
+        run(robot, segments)
+        elapsed = (time.perf_counter() - start) * time_scale
+        return elapsed, len(segments)
+
+    def one_at_a_time(robot, segments):
+        for left, right, seconds in segments:
+            robot.motors(left, right, seconds)
+
+    def trajectory(robot, segments):
+        robot.run_trajectory(segments)
+
+    before, n = mission(one_at_a_time)
+    after, n = mission(trajectory)
+    print(f"maze mission ({n} segments): motors {before:6.1f} s | run_trajectory {after:6.1f} s")
+    return {"segments": n, "motors_s": before, "run_trajectory_s": after}
+
+def random_maze(size, density, rng):
+    """Grid with density of its cells blocked, except the corners (start and goal)"""
+    grid = OccupancyGrid(size, size)
+    for x in range(size):
+        for y in range(size):
+            if rng.random() < density:
+                grid.block((x, y))
+    grid.unblock((0, 0))
+    grid.unblock((size - 1, size - 1))
+    return grid
+
+def cell_by_cell_segments(path, heading=0, cell_seconds=2, degrees_per_second=58.8):
+    """One spin and one forward segment per cell, spinning by the heading
+    difference without picking the short way round (the old angleCalculate)"""
+    segments = []
+    for here, there in zip(path, path[1:]):
+        new_heading = MOVE_HEADINGS[(there[0] - here[0], there[1] - here[1])]
+        if new_heading != heading:
+            segments.append((FORWARD, BACKWARD, abs(new_heading - heading) / degrees_per_second))
+        segments.append((FORWARD, FORWARD, cell_seconds))
+        heading = new_heading
+    return segments
+
+def bench_maze_plans(n_grids=200, size=16, density=0.25):
+    """Mission time (seconds of motor commands) and number of segments for
+    random mazes, from one corner to the other"""
+    rng = random.Random(0)
+    totals = {"cell by cell": [0, 0], "merged, short turns": [0, 0], "turn weighted": [0, 0]}
+    solved = 0
+    for _ in range(n_grids):
+        grid = random_maze(size, density, rng)
+        goal = (size - 1, size - 1)
+        shortest = bfs_path(grid, (0, 0), goal)
+        if shortest is None:
+            continue
+        solved += 1
+        distances = distance_field(grid, goal)
+        quickest = turn_weighted_path(grid, (0, 0), goal, moves_to_goal=lambda cell: distances[cell[1], cell[0]])
+        for name, segments in (("cell by cell", cell_by_cell_segments(shortest)),
+                               ("merged, short turns", path_segments(shortest)),
+                               ("turn weighted", path_segments(quickest))):
+            totals[name][0] += sum(seconds for _, _, seconds in segments)
+            totals[name][1] += len(segments)
+    print(f"{solved} random {size}x{size} mazes ({density:.0%} blocked):")
+    results = {"mazes": solved}
+    for name, (seconds, segments) in totals.items():
+        print(f"  {name:20} {seconds / solved:6.1f} s mission | {segments / solved:5.1f} segments")
+        results[name] = {"mission_s": seconds / solved, "segments": segments / solved}
+    return results
+
+def bench_mapping(readings=20000):
+    """Sonar readings added to an OccupancyMap per second, on maps from 100x100 to
+    4000x4000 cells (the cost should stay the same, since only cells on the ray change),
+    and the time to turn the biggest one into an OccupancyGrid"""
+    rng = random.Random(0)
+    results = {}
+    for size in (100, 1000, 4000):
+        # 1 cm cells, so a 400 cm reading crosses up to 400 of them
+        seen = OccupancyMap(size, size, cell_cm=1)
+        rays = [(rng.uniform(0, size), rng.uniform(0, size), rng.uniform(0, 360), rng.uniform(5, 450))
+                for _ in range(readings)]
+        start = time.perf_counter()
+        for x, y, heading, distance in rays:
+            seen.update(x, y, heading, distance)
+        per_reading = (time.perf_counter() - start) / readings
+        print(f"{size:4}x{size:<4} map: {1 / per_reading:8.0f} readings/s ({per_reading * 1e6:5.1f} us each)")
+        results[f"{size}x{size}_readings_per_s"] = 1 / per_reading
+    to_grid = time_per_call(seen.occupancy_grid, 10)
+    print(f"occupancy_grid() on {size}x{size}: {to_grid * 1000:.1f} ms")
+    results["occupancy_grid_ms"] = to_grid * 1000
+    return results
+
+def bench_physics(frames=20000):
+    """Headless physics frames per second
+
+    Frame by frame (_update_position and _detect_crash every frame, like
+    motors() used to run) and in one go with _advance (what motors() does
+    headless), for spinning and for driving back and forth.
+    """
+    driver = SimulatorDriver(headless=True)
+    results = {}
+
+    def step(left, right):
+        driver._update_position(left, right)
+        driver._detect_crash()
+
+    results["stepped_spin_frames_per_s"] = 1 / time_per_call(lambda: step(FORWARD, BACKWARD), frames)
+
+    # 800 frames is 800 mm, so the robot never reaches a wall
+    direction = [FORWARD]
+    def back_and_forth():
+        driver._advance(direction[0], direction[0], 800)
+        direction[0] = -direction[0]
+    driver.x = driver.y = driver.heading = 0
+    results["advance_straight_frames_per_s"] = 800 / time_per_call(back_and_forth, max(1, frames // 80))
+    results["advance_spin_frames_per_s"] = frames / time_per_call(lambda: driver._advance(FORWARD, BACKWARD, frames), 20)
+
+    for name, value in results.items():
+        print(f"{name:32} {value:14.0f}")
+    return results
+
+def bench_crash_frames(trials=2000, seed=0):
+    """Straight drives where _advance's closed-form crash frame differs from
+    stepping frame by frame (should be 0), with obstacles placed so that the
+    robot's corners just graze them part-way along
+    """
+    rng = random.Random(seed)
+    driver = SimulatorDriver(headless=True)
+    mismatches = 0
+    for _ in range(trials):
+        heading = rng.choice([0, 45, 90, rng.uniform(0, 360)])
+        driver.x, driver.y, driver.heading = rng.uniform(-300, 300), rng.uniform(-150, 150), heading
+        forward = rng.choice([1, -1, 0.5, 7.5, rng.uniform(-8, 8)])
+        num_frames = rng.randint(1, 400)
+        driver.geometry.update(driver.x, driver.y, heading)
+        corners = driver.geometry.corner_points()
+        obstacles = []
+        for _ in range(rng.randint(1, 4)):
+            # An obstacle corner on the path of a robot corner
+            k = rng.uniform(0, num_frames)
+            corner_x, corner_y = rng.choice(corners)
+            width, height = rng.uniform(0.01, 40), rng.uniform(0.01, 40)
+            nudge = lambda: rng.choice([0, 1e-9, -1e-9, 1e-12, -1e-12, rng.uniform(-2, 2)])
+            obstacles.append(Obstacle(
+                corner_x + k * forward * math.cos(math.radians(heading)) + rng.choice([-1, 1]) * width / 2 + nudge(),
+                corner_y + k * forward * math.sin(math.radians(heading)) + rng.choice([-1, 1]) * height / 2 + nudge(),
+                width, height, rng.choice([0, heading, rng.uniform(0, 360)])))
+        driver.set_obstacles(obstacles)
+        if driver._crash_at(driver.x, driver.y, heading):
+            continue
+        closed_form = driver._first_crash_frame_straight(forward, num_frames)
+        stepped = next((k for k in range(1, num_frames + 1)
+                        if driver._crash_at(*driver._pose_after(0, forward, k))), None)
+        mismatches += closed_form != stepped
+    results = {"trials": trials, "mismatches": mismatches}
+    for name, value in results.items():
+        print(f"{name:32} {value:14}")
+    return results
+
+def bench_sonars(repeats=5000):
+    """sonars() calls per second, with no obstacles and with the 3 standard obstacles"""
+    results = {}
+    for n_obstacles in (0, 3):
+        driver = SimulatorDriver(n_obstacles=n_obstacles, headless=True)
+        driver.heading = 37
+        results[f"{n_obstacles}_obstacles_calls_per_s"] = 1 / time_per_call(driver.sonars, repeats)
+    for name, value in results.items():
+        print(f"sonars() {name:24} {value:10.0f}")
+    return results
+
+def bench_render(frames=300):
+    """render() frames per second (turning a little every frame, with the 3 standard obstacles)"""
+    driver = SimulatorDriver(n_obstacles=3)
+
+    def turn_and_render():
+        driver.heading = (driver.heading + 1.3) % 360
+        driver.render()
+
+    fps = 1 / time_per_call(turn_and_render, frames)
+    print(f"render() frames/s {fps:8.0f}")
+    return {"frames_per_s": fps}
+
+def main_mission_commands(targets=(-250, -120, 0, 130, 260), speed_mm_per_s=60, degrees_per_second=58.8):
+    """The motors commands main.py gives for a round trip to each target y coordinate
+
+    Like main.py: turn to face the target, drive there, turn around, drive
+    back and turn to face forward again.
+    """
+    commands = []
+    for target_y in targets:
+        target_x = 899 - (100 * 2 ** 0.5 - 100)
+        angle = math.degrees(math.atan2(target_y, target_x))
+        # Stop short of the wall, the simulator doesn't allow touching it
+        distance = 0.8 * math.hypot(target_x, target_y)
+        for turn, forward in ((angle, distance), (180, distance), (normalize_angle(-180 - angle), 0)):
+            spin = spin_segment(normalize_angle(turn), degrees_per_second)
+            if spin is not None:
+                commands.append(spin)
+            if forward:
+                commands.append((FORWARD, FORWARD, forward / speed_mm_per_s))
+    return commands
+
+def bench_missions():
+    """End to end time of scripted missions in the headless simulator
+
+    A main.py style round trip to five targets, and the MazeSolverRecent.py
+    plan for a random maze (planning and driving). Reports the wall time
+    and how long the missions take the robot (simulated seconds).
+    """
+    results = {}
+
+    commands = main_mission_commands()
+    robot = Robot(headless=True)
+    start = time.perf_counter()
+    for left, right, seconds in commands:
+        robot.motors(left, right, seconds)
+    results["main_wall_ms"] = (time.perf_counter() - start) * 1e3
+    results["main_robot_s"] = sum(seconds for _, _, seconds in commands)
+
+    rng = random.Random(1)
+    grid = random_maze(8, 0.2, rng)
+    while bfs_path(grid, (0, 0), (7, 7)) is None:
+        grid = random_maze(8, 0.2, rng)
+    robot = Robot(headless=True)
+    # 8 cm cells, so the 8x8 grid (and the robot spinning at its corners) fits in the 1 m wide arena
+    robot.driver.x = robot.driver.y = -280
+    start = time.perf_counter()
+    distances = distance_field(grid, (7, 7))
+    path = turn_weighted_path(grid, (0, 0), (7, 7), moves_to_goal=lambda cell: distances[cell[1], cell[0]])
+    results["maze_robot_s"] = robot.run_trajectory(path_segments(path, cell_cm=8))
+    results["maze_wall_ms"] = (time.perf_counter() - start) * 1e3
+
+    print(f"main.py mission:         {results['main_wall_ms']:7.2f} ms wall | {results['main_robot_s']:6.1f} s robot")
+    print(f"MazeSolverRecent mission: {results['maze_wall_ms']:7.2f} ms wall | {results['maze_robot_s']:6.1f} s robot")
+    return results
+
+BENCHMARKS = {
+    "physics": bench_physics,
+    "crash_frames": bench_crash_frames,
+    "sonars": bench_sonars,
+    "render": bench_render,
+    "missions": bench_missions,
+    "sonar_obstacles": bench_sonar_obstacles,
+    "geometry": bench_geometry,
+    "maze_mission": bench_maze_mission,
+    "maze_plans": bench_maze_plans,
+    "mapping": bench_mapping,
+}
+
+def flatten(results, prefix=""):
+    """{"a": {"b": 1}} -> {"a.b": 1}"""
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + name + "."))
+        else:
+            flat[prefix + name] = value
+    return flat
+
+def compare(old_results, new_results):
+    """Print every number in both result sets, with how much it changed"""
+    old = flatten(old_results["results"])
+    new = flatten(new_results["results"])
+    print(f"{'':50} {'before':>12} {'after':>12} {'change':>8}")
+    for name in sorted(old.keys() & new.keys()):
+        before, after = old[name], new[name]
+        change = f"{(after - before) / before:+8.0%}" if before else ""
+        print(f"{name:50} {before:12.4g} {after:12.4g} {change}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulator benchmarks")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="benchmarks to run (all if not given)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"== {name}")
+        results[name] = BENCHMARKS[name]()
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+    return report
+
+if __name__ == "__main__":
+    main()
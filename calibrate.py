@@ -1,7 +1,8 @@
 from simulator import robot, FORWARD, BACKWARD, STOP
+from calibration import auto_calibrate, save_profile, profile_path
 
 while True:
-    command = input("Motor (m) or Sonars (s) or Quit (q)? ")
+    command = input("Motor (m) or Sonars (s) or Auto calibrate (a) or Quit (q)? ")
     if command == "m":
         left_power = int(input("Left motor: "))
         right_power = int(input("Right motor: "))
@@ -13,7 +14,22 @@ while True:
         print("Left: ", robot.left_sonar())
         print("Right: ", robot.right_sonar())
 
+    elif command == "a":
+        # the robot needs to face a wall 25-150 cm away, about straight on
+        # (nothing is saved if the measurements don't make sense)
+        try:
+            profile = auto_calibrate(robot)
+        except Exception as error:
+            print(error)
+            continue
+        print("Forward: ", profile["cm_per_second"], "cm/s")
+        print("Backward: ", profile["cm_per_second_backward"], "cm/s")
+        print("Turning left: ", profile["degrees_per_second_left"], "degrees/s")
+        print("Turning right: ", profile["degrees_per_second_right"], "degrees/s")
+        save_profile(profile)
+        robot.load_profile()
+        print("Saved to", profile_path())
+
     elif command == "q":
         robot.exit()
         break
-
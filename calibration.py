@@ -0,0 +1,175 @@
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+# Distance between the two sonars in cm (a 20 cm front edge, each sonar 3 cm in from a corner)
+SONAR_BASELINE = 14
+
+# Where Robot looks for a profile, if the ROBOT_PROFILE environment variable isn't set
+PROFILE_PATH = "robot_profile.json"
+
+def wall_angle(left, right, baseline=SONAR_BASELINE):
+    """Angle (degrees) between the robot's heading and straight at a wall in front of it
+
+    Both sonars point the same way, so when the robot is turned towards its
+    left the left sonar is further from the wall: left - right =
+    baseline * tan(angle). Positive angles are counter-clockwise (turned left).
+    """
+    return math.degrees(math.atan2(left - right, baseline))
+
+def fit_rate(times, values):
+    """Least-squares straight line through (time, value) points
+
+    Returns: (rate per second, value at time 0, root mean square of what the line misses by)
+    """
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    rate, start = np.polyfit(times, values, 1)
+    residuals = values - (rate * times + start)
+    return float(rate), float(start), float(np.sqrt(np.mean(residuals ** 2)))
+
+def _measure(robot, readings):
+    """Median of several readings of each sonar, in cm"""
+    lefts, rights = [], []
+    for _ in range(readings):
+        lefts.append(robot.left_sonar())
+        rights.append(robot.right_sonar())
+    return float(np.median(lefts)), float(np.median(rights))
+
+def _drive_steps(robot, left, right, step_seconds, steps, readings, keep_going, moved):
+    """Run the motors in short steps, measuring after each one
+
+    Every step is added to `moved` (see _move_back).
+
+    Returns: lists of the time driven so far and the (left, right) readings,
+    starting with the readings before moving
+    """
+    times = [0.0]
+    measured = [_measure(robot, readings)]
+    for step in range(1, steps + 1):
+        robot.motors(left, right, step_seconds)
+        moved["drive"] += (left + right) / 2 * step_seconds
+        moved["turn"] += (left - right) / 2 * step_seconds
+        times.append(step * step_seconds)
+        measured.append(_measure(robot, readings))
+        if not keep_going(*measured[-1]):
+            break
+    return times, measured
+
+def _move_back(robot, moved):
+    """Undo the turning and driving in `moved` (seconds at full power, forward and counter-clockwise)
+
+    Runs the motors the other way for the same time, so it doesn't need the
+    rates, which are wrong if the calibration failed.
+    """
+    if moved["turn"] > 0:
+        robot.motors(-1, 1, moved["turn"])
+    elif moved["turn"] < 0:
+        robot.motors(1, -1, -moved["turn"])
+    if moved["drive"] > 0:
+        robot.motors(-1, -1, moved["drive"])
+    elif moved["drive"] < 0:
+        robot.motors(1, 1, -moved["drive"])
+
+def _check_fit(name, rate, rms, max_rms, unit):
+    """Raise if a fitted rate can't be right, so a bad calibration never gets saved"""
+    if not math.isfinite(rate) or rate <= 0:
+        raise Exception(f"Ooops! Dr. Ebee measured its {name} as {rate} {unit}/s, which can't be right. "
+                        f"Check the wall is in front of the robot and try again")
+    if not rms <= max_rms:
+        raise Exception(f"Ooops! Dr. Ebee's {name} readings were {rms:.2f} {unit} from a straight line "
+                        f"(more than {max_rms}), so the sonars were probably seeing something else. "
+                        f"Try again with nothing else nearby")
+
+def auto_calibrate(robot, step_seconds=0.5, turn_step_seconds=0.05, closest=25, furthest=150, max_angle=15,
+                   readings=3, max_distance_rms=2, max_angle_rms=3):
+    """Measure how fast the robot drives and turns, using a wall in front of it
+
+    Put the robot facing a wall, about straight on and between closest and
+    furthest cm from it. The robot drives towards the wall and back in
+    step_seconds steps, then turns left and right in turn_step_seconds
+    steps (no more than max_angle degrees either way), reading both sonars
+    `readings` times after every step. Straight lines fitted to the
+    distances and to the wall angles (see wall_angle) give the speed and
+    turn rate in each direction. The robot ends up about where it started.
+
+    If a rate isn't a positive number, or the readings are further than
+    max_distance_rms cm (or max_angle_rms degrees) from the fitted line on
+    average, it raises an Exception instead of returning a bad profile.
+    Before raising, it drives and turns back by as long as it moved, so it
+    can be run again from about the same place.
+
+    Returns: profile dict to pass to save_profile()
+    """
+    left, right = _measure(robot, readings)
+    if not (closest < left < furthest and closest < right < furthest):
+        raise Exception(f"Ooops! Dr. Ebee needs to face a wall between {closest} and {furthest} cm away "
+                        f"to calibrate, but the sonars read {left} and {right} cm")
+    if abs(wall_angle(left, right)) > max_angle:
+        raise Exception("Ooops! Dr. Ebee needs to face the wall about straight on to calibrate")
+    steps = max(1, round((min(left, right) - closest) / (robot.cm_per_second * step_seconds)))
+    moved = {"drive": 0.0, "turn": 0.0}
+
+    try:
+        # Forward towards the wall, then back the same number of steps
+        times, measured = _drive_steps(robot, 1, 1, step_seconds, steps, readings,
+                                       lambda left, right: min(left, right) > closest, moved)
+        forward = fit_rate(times, [(left + right) / 2 for left, right in measured])
+        times, measured = _drive_steps(robot, -1, -1, step_seconds, len(times) - 1, readings,
+                                       lambda left, right: max(left, right) < furthest, moved)
+        backward = fit_rate(times, [(left + right) / 2 for left, right in measured])
+        # The distance goes down going forward
+        _check_fit("forward speed", -forward[0], forward[2], max_distance_rms, "cm")
+        _check_fit("backward speed", backward[0], backward[2], max_distance_rms, "cm")
+
+        # Left (counter-clockwise) to max_angle, right to -max_angle, then back to the start
+        turn_steps = max(2, round(max_angle / (robot.degrees_per_second * turn_step_seconds)))
+        times, measured = _drive_steps(robot, 1, -1, turn_step_seconds, turn_steps, readings,
+                                       lambda left, right: wall_angle(left, right) < max_angle, moved)
+        turn_left = fit_rate(times, [wall_angle(left, right) for left, right in measured])
+        times, measured = _drive_steps(robot, -1, 1, turn_step_seconds, 2 * (len(times) - 1), readings,
+                                       lambda left, right: wall_angle(left, right) > -max_angle, moved)
+        turn_right = fit_rate(times, [wall_angle(left, right) for left, right in measured])
+        _check_fit("left turn rate", turn_left[0], turn_left[2], max_angle_rms, "degrees")
+        _check_fit("right turn rate", -turn_right[0], turn_right[2], max_angle_rms, "degrees")
+    except Exception:
+        _move_back(robot, moved)
+        raise
+    angle = wall_angle(*measured[-1])
+    if angle < 0:
+        robot.motors(1, -1, -angle / turn_left[0])
+    elif angle > 0:
+        robot.motors(-1, 1, angle / -turn_right[0])
+
+    return {
+        "driver": type(robot.driver).__name__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cm_per_second": -forward[0],
+        "cm_per_second_backward": backward[0],
+        "degrees_per_second_left": turn_left[0],
+        "degrees_per_second_right": -turn_right[0],
+        "degrees_per_second": (turn_left[0] - turn_right[0]) / 2,
+        # How far the readings were from the fitted lines (cm or degrees)
+        "fit_rms": {"forward": forward[2], "backward": backward[2],
+                    "left": turn_left[2], "right": turn_right[2]},
+    }
+
+def profile_path(path=None):
+    if path is None:
+        path = os.environ.get("ROBOT_PROFILE", PROFILE_PATH)
+    return path
+
+def save_profile(profile, path=None):
+    with open(profile_path(path), "w") as file:
+        json.dump(profile, file, indent=2)
+
+def load_profile(path=None):
+    """The saved profile, or None if there isn't one"""
+    path = profile_path(path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
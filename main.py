@@ -7,21 +7,22 @@ debug = False
 def rotateTo(angle):
     """Simple version, only rotates to the left \n
     Angle is a postive float to rotate that many degrees"""
-    angleInSeconds = (angle)/(0.98 * 60)
+    angleInSeconds = (angle)/(robot.degrees_per_second)
     motorsAndWait(FORWARD,BACKWARD,abs(angleInSeconds))
 def AdvancedRotateTo(angle):
     if(angle%360 == 0):
         debugDirrection = None
-        angleInSeconds = 0
+        turnAngle = 0
     elif(angle%360<=180):
-        angleInSeconds = (angle)/(0.98 * 60)
+        turnAngle = angle%360
         debugDirrection = "right"
-        motorsAndWait(FORWARD,BACKWARD,abs(angleInSeconds))
     else:
-        angleInSeconds = (180-(angle%180))/(0.98 * 60)
+        turnAngle = -(180-(angle%180))
         debugDirrection = "left"
-        motorsAndWait(BACKWARD,FORWARD,abs(angleInSeconds))
-    print(f"angle: {angle} converted to {angleInSeconds} while turning to the {debugDirrection}")
+    if(turnAngle != 0):
+        # stops on the angle the sonars measure when it ends up facing a wall
+        robot.turn(turnAngle)
+    print(f"angle: {angle} converted to {turnAngle} degrees while turning to the {debugDirrection}")
 def motorsAndWait(Left,Right,Seconds):
     """calls the motors for the specified time \n
     left = FORWARD, BACKWARD, STOP \n
@@ -125,7 +126,7 @@ while True:
         vector = (abs(vector[1]),abs(vector[0]))
     else:
         raise Exception("Signs don't meet any conditions")
-    speed_per_power_in_seconds = 60
+    speed_per_power_in_seconds = robot.cm_per_second * 10 # mm per second, measured by calibrate.py
     try:
         angleInRad = (np.arctan(vector[1]/vector[0]))
     except ZeroDivisionError:
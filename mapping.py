@@ -0,0 +1,125 @@
+import math
+
+import numpy as np
+
+from planner import OccupancyGrid
+
+def bresenham(x0, y0, x1, y1):
+    """Cells on the line from cell (x0, y0) to cell (x1, y1), both included
+
+    Same cells as Bresenham's line algorithm (one per step along the longer
+    axis, rounding the other to the nearest cell), but worked out with NumPy
+    for all the steps at once.
+
+    Returns: (xs, ys) int arrays
+    """
+    dx, dy = x1 - x0, y1 - y0
+    steps = max(abs(dx), abs(dy))
+    if steps == 0:
+        return np.array([x0]), np.array([y0])
+    t = np.arange(steps + 1)
+    # floor((2 * t * d + steps) / (2 * steps)) rounds t * d / steps half up, in integers
+    xs = x0 + (2 * t * dx + steps) // (2 * steps)
+    ys = y0 + (2 * t * dy + steps) // (2 * steps)
+    return xs, ys
+
+def log_odds(probability):
+    return math.log(probability / (1 - probability))
+
+class OccupancyMap:
+    """What the sonars have seen, as a grid of log-odds that each cell is occupied
+
+    Each reading is a ray from the sonar along the robot's heading. The
+    cells it passed through are probably free, so their log-odds go down by
+    `miss`, and the cell where the echo came from is probably occupied, so
+    its log-odds go up by `hit`. Adding log-odds is the same as applying
+    Bayes' rule to the probabilities, so many noisy readings add up to a
+    confident map. Only the cells along the ray are touched, and rays are
+    cut off at max_range, so a reading costs the same on any size of map.
+
+    Cells are (x, y) pairs like OccupancyGrid's, stored in a NumPy array
+    indexed [y][x]. Positions are in cm, with origin the position of the
+    corner of cell (0, 0).
+
+    Parameters:
+    * width, height: size of the map in cells
+    * cell_cm: size of a cell in cm
+    * origin: (x, y) in cm of the corner of cell (0, 0)
+    * hit, miss: probability that a cell is occupied when the echo came
+      from it, or when the ray passed through it
+    * limit: log-odds are kept between -limit and limit, so the map can
+      still change its mind when something moves
+    * max_range: readings further than this (cm) only mark free cells
+
+    Example:
+    seen = OccupancyMap(100, 50, cell_cm=2, origin=(-100, -50))
+    seen.update_sonars(robot.odometry.pose, robot.left_sonar(), robot.right_sonar())
+    grid = seen.occupancy_grid()
+    """
+
+    def __init__(self, width, height, cell_cm=12, origin=(0, 0), hit=0.7, miss=0.4, limit=5, max_range=400):
+        self.width = width
+        self.height = height
+        self.cell_cm = cell_cm
+        self.origin = origin
+        self.hit = log_odds(hit)
+        self.miss = log_odds(miss)
+        self.limit = limit
+        self.max_range = max_range
+        self.log_odds = np.zeros((height, width), dtype=np.float32)
+
+    def cell(self, x, y):
+        """Cell that the position (x, y) in cm is in"""
+        return (math.floor((x - self.origin[0]) / self.cell_cm),
+                math.floor((y - self.origin[1]) / self.cell_cm))
+
+    def in_bounds(self, cell):
+        x, y = cell
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def update(self, x, y, heading, distance):
+        """Add one sonar reading: from (x, y) cm, pointing at heading degrees, distance cm
+
+        A reading of infinity (no echo) marks the whole ray up to max_range as
+        free. Readings that aren't a number or are negative are ignored.
+        """
+        if not distance >= 0:
+            return
+        hit = distance <= self.max_range
+        length = min(distance, self.max_range)
+        end_x = x + length * math.cos(math.radians(heading))
+        end_y = y + length * math.sin(math.radians(heading))
+        xs, ys = bresenham(*self.cell(x, y), *self.cell(end_x, end_y))
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+
+        # The cells on the line are all different, so they can be updated in one go
+        update = np.full(len(xs), self.miss, dtype=np.float32)
+        if hit:
+            update[-1] = self.hit
+        cells = self.log_odds[ys[inside], xs[inside]] + update[inside]
+        self.log_odds[ys[inside], xs[inside]] = np.clip(cells, -self.limit, self.limit)
+
+    def update_sonars(self, pose, left, right, sonar_forward=10, sonar_side=7):
+        """Add a reading of each sonar, taken with the robot at pose (x, y, heading)
+
+        The sonars sit sonar_forward cm in front of the robot's centre and
+        sonar_side cm either side of it, both pointing along the heading.
+        """
+        x, y, heading = pose
+        cos_h, sin_h = math.cos(math.radians(heading)), math.sin(math.radians(heading))
+        for side, distance in ((sonar_side, left), (-sonar_side, right)):
+            self.update(x + sonar_forward * cos_h - side * sin_h,
+                        y + sonar_forward * sin_h + side * cos_h, heading, distance)
+
+    def probability(self):
+        """Probability that each cell is occupied, indexed [y][x] (0.5 for cells never seen)"""
+        return 1 / (1 + np.exp(-self.log_odds))
+
+    def occupancy_grid(self, threshold=0.65):
+        """OccupancyGrid for the planners, with the cells more likely than threshold to be occupied blocked
+
+        Cells nothing has been seen in count as free, so the planners try them.
+        """
+        grid = OccupancyGrid(self.width, self.height)
+        grid.blocked = self.log_odds > log_odds(threshold)
+        return grid
@@ -1,17 +1,13 @@
-grid = []
 x = 8
 import numpy as np
-for i in range(0,x):
-    grid.append("o" * int(x))
+from planner import OccupancyGrid, distance_field
+grid = OccupancyGrid(x, x)
 where = (0,0)
 goal = (3,3)
 direction = 0
 def createMap():
-    mapping = grid.copy()
-    for i in range(len(grid)):
-        for j in range(len(grid[i])):
-            mapping[i] = mapping[i][:j] + str(np.abs(j - goal[0]) + np.abs(i-goal[1])) + mapping[i][j+1:]
-    return(mapping)
+    # moves from every cell to the goal, going around blocked cells
+    return(distance_field(grid, goal))
 def sonarScan():
     return(False)
 def forward():
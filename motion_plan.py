@@ -0,0 +1,145 @@
+import heapq
+
+from planner import UNREACHABLE
+
+# Heading (degrees) of each move to a neighbouring cell, as the maze solvers use them
+MOVE_HEADINGS = {(1, 0): 0, (0, 1): 90, (-1, 0): 180, (0, -1): 270}
+HEADING_MOVES = {heading: move for move, heading in MOVE_HEADINGS.items()}
+
+def normalize_angle(angle):
+    """The same turn as angle, between -180 and 180 degrees (so 270 becomes -90)"""
+    return (angle + 180) % 360 - 180
+
+# Pivoting on one stopped wheel at full power, as measured on the real robot:
+# half the spin rate, and 75mm in 6 seconds forward (0.208 of full speed)
+PIVOT_TURN = 0.5
+PIVOT_FORWARD = 0.208
+
+def drive_model(left, right):
+    """How fast a pair of wheel powers turns and drives the robot, as fractions of full speed
+
+    FORWARD, BACKWARD and STOP on each wheel move the robot the way they
+    always have: both wheels the same way drives straight, opposite ways
+    spins in place (counter-clockwise for left FORWARD), and one wheel
+    stopped pivots at the speeds measured on the real robot (PIVOT_TURN,
+    PIVOT_FORWARD), counter-clockwise when the other wheel goes forward.
+    Any other powers (PWM) use the differential drive model: the robot
+    drives at the average of the two powers and turns by half their
+    difference. The simulator and the odometry both move the robot with
+    this, so they agree.
+
+    Returns: (turn, forward), turn positive for counter-clockwise
+    """
+    if left != right and (left == 0 or right == 0) and abs(left + right) == 1:
+        power = left + right
+        return power * PIVOT_TURN, power * PIVOT_FORWARD
+    return (left - right) / 2, (left + right) / 2
+
+def spin_segment(turn, degrees_per_second):
+    """(left, right, seconds) that spins the robot in place by turn degrees, or None for no turn
+
+    Positive turns are counter-clockwise, which in the simulator is the left
+    wheel FORWARD (1) and the right wheel BACKWARD (-1).
+    """
+    if turn > 0:
+        return (1, -1, turn / degrees_per_second)
+    if turn < 0:
+        return (-1, 1, -turn / degrees_per_second)
+    return None
+
+def turn_weighted_path(grid, start, goal, heading=0, cell_seconds=2, degrees_per_second=58.8, moves_to_goal=None):
+    """Quickest path from start to goal, counting the time spent turning
+
+    A* over (cell, heading) pairs: driving to the next cell in the robot's
+    heading takes cell_seconds, and turning takes the time to spin the short
+    way round. Of all the shortest paths this picks the one with the fewest
+    turns, and it takes a longer path when that saves enough turning.
+
+    Parameters:
+    * heading: which way the robot faces at start (0, 90, 180 or 270)
+    * moves_to_goal: function giving the number of moves from a cell to
+      goal ignoring turns (e.g. DStarLite.distance, or looked up in a
+      planner.distance_field), used to guide the search. It must not be
+      more than the real number of moves. The Manhattan distance is used
+      if None.
+
+    Returns: list of cells from start to goal (both included), or None
+    """
+    start, goal = tuple(start), tuple(goal)
+    if moves_to_goal is None:
+        def moves_to_goal(cell):
+            return abs(cell[0] - goal[0]) + abs(cell[1] - goal[1])
+
+    def estimate(cell):
+        moves = moves_to_goal(cell)
+        return None if moves == UNREACHABLE else moves * cell_seconds
+
+    if grid.is_blocked(start) or estimate(start) is None:
+        return None
+    start_state = (start, heading % 360)
+    cost = {start_state: 0}
+    came_from = {start_state: None}
+    open_states = [(estimate(start), 0, start_state)]
+    while open_states:
+        _, time_so_far, state = heapq.heappop(open_states)
+        if time_so_far > cost[state]:
+            continue  # Already reached more quickly
+        cell, facing = state
+        if cell == goal:
+            path = []
+            while state is not None:
+                if not path or path[-1] != state[0]:
+                    path.append(state[0])
+                state = came_from[state]
+            return path[::-1]
+
+        dx, dy = HEADING_MOVES[facing]
+        options = [((cell[0] + dx, cell[1] + dy), facing, cell_seconds)]
+        for new_facing in HEADING_MOVES:
+            if new_facing != facing:
+                turn_seconds = abs(normalize_angle(new_facing - facing)) / degrees_per_second
+                options.append((cell, new_facing, turn_seconds))
+        for next_cell, next_facing, seconds in options:
+            if not grid.in_bounds(next_cell) or grid.is_blocked(next_cell):
+                continue
+            remaining = estimate(next_cell)
+            if remaining is None:
+                continue
+            next_state = (next_cell, next_facing)
+            next_time = time_so_far + seconds
+            if next_time < cost.get(next_state, float("inf")):
+                cost[next_state] = next_time
+                came_from[next_state] = state
+                heapq.heappush(open_states, (next_time + remaining, next_time, next_state))
+    return None
+
+def straight_runs(path):
+    """Group a path of neighbouring cells into straight lines
+
+    Returns: list of (heading, number of cells) for each straight line
+    """
+    runs = []
+    for here, there in zip(path, path[1:]):
+        heading = MOVE_HEADINGS[(there[0] - here[0], there[1] - here[1])]
+        if runs and runs[-1][0] == heading:
+            runs[-1] = (heading, runs[-1][1] + 1)
+        else:
+            runs.append((heading, 1))
+    return runs
+
+def path_segments(path, heading=0, cell_cm=12, cm_per_second=6, degrees_per_second=58.8):
+    """Motor commands that drive a path, for Robot.run_trajectory()
+
+    Each straight line of cells becomes one long forward segment, after
+    spinning the short way round to face along it.
+
+    Returns: list of (left, right, seconds)
+    """
+    segments = []
+    for run_heading, cells in straight_runs(path):
+        spin = spin_segment(normalize_angle(run_heading - heading), degrees_per_second)
+        if spin is not None:
+            segments.append(spin)
+        segments.append((1, 1, cells * cell_cm / cm_per_second))
+        heading = run_heading
+    return segments
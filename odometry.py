@@ -0,0 +1,95 @@
+import math
+
+from calibration import SONAR_BASELINE, wall_angle
+from motion_plan import drive_model, normalize_angle
+
+class PoseEstimator:
+    """Running estimate of the robot's (x, y, heading), from its motor commands and sonars
+
+    predict() moves the estimate by what the motors were told to do, using
+    the robot's measured speeds, and makes it less sure of the heading.
+    update() looks at the two sonars: when they both see a wall in front,
+    their difference gives the angle to that wall (see
+    calibration.wall_angle), and so the heading, if the walls run along
+    wall_headings. The two are combined like a 1-D Kalman filter, so a
+    good wall reading pulls the heading most of the way back after a long
+    turn, and a noisy one only a little.
+
+    x and y are in cm and the heading in degrees (counter-clockwise, 0 =
+    along x), all measured from where the robot started.
+
+    Parameters:
+    * cm_per_second, degrees_per_second: full-power speeds (see calibrate.py)
+    * turn_noise: standard deviation of a turn, as a fraction of the turn
+    * drift_noise: standard deviation of the heading (degrees) per cm driven
+    * angle_noise: variance of a heading measured from the sonars (degrees^2)
+    * wall_headings: headings that face straight at a wall (the robot
+      starts square to the walls of the box)
+    * max_wall_angle: wall angles further than this are ignored (the outer
+      sonar might be seeing a different wall)
+    """
+
+    def __init__(self, cm_per_second=6, degrees_per_second=58.8, x=0, y=0, heading=0,
+                 turn_noise=0.05, drift_noise=0.05, angle_noise=4.0,
+                 wall_headings=(0, 90, 180, 270), max_wall_angle=15, baseline=SONAR_BASELINE):
+        self.cm_per_second = cm_per_second
+        self.degrees_per_second = degrees_per_second
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.heading_variance = 0.0
+        self.turn_noise = turn_noise
+        self.drift_noise = drift_noise
+        self.angle_noise = angle_noise
+        self.wall_headings = wall_headings
+        self.max_wall_angle = max_wall_angle
+        self.baseline = baseline
+
+    @property
+    def pose(self):
+        return self.x, self.y, self.heading
+
+    def predict(self, left, right, seconds):
+        """Move the estimate by `seconds` of motor power (left, right)
+
+        Uses the same drive model as the simulator (motion_plan.drive_model),
+        following the arc it gives.
+        """
+        turn_rate, speed = drive_model(left, right)
+        distance = speed * self.cm_per_second * seconds
+        turn = turn_rate * self.degrees_per_second * seconds
+        heading = math.radians(self.heading)
+        if turn == 0:
+            self.x += distance * math.cos(heading)
+            self.y += distance * math.sin(heading)
+        else:
+            radius = distance / math.radians(turn)
+            self.x += radius * (math.sin(heading + math.radians(turn)) - math.sin(heading))
+            self.y += radius * (math.cos(heading) - math.cos(heading + math.radians(turn)))
+        self.heading = (self.heading + turn) % 360
+        self.heading_variance += (self.turn_noise * turn) ** 2 + (self.drift_noise * distance) ** 2
+
+    def measured_heading(self, left, right):
+        """Heading given by the angle to the wall the sonars see, or None if they don't both see one"""
+        if not (math.isfinite(left) and math.isfinite(right)):
+            return None
+        angle = wall_angle(left, right, self.baseline)
+        if abs(angle) > self.max_wall_angle:
+            return None
+        # The robot faces the wall whose heading is closest to what we think
+        facing = self.heading - angle
+        wall = min(self.wall_headings, key=lambda heading: abs(normalize_angle(facing - heading)))
+        return (wall + angle) % 360
+
+    def update(self, left, right):
+        """Correct the heading with a sonar reading of each side (in cm)
+
+        Returns: the heading measured from the sonars, or None if they didn't give one
+        """
+        measured = self.measured_heading(left, right)
+        if measured is None:
+            return None
+        gain = self.heading_variance / (self.heading_variance + self.angle_noise)
+        self.heading = (self.heading + gain * normalize_angle(measured - self.heading)) % 360
+        self.heading_variance *= 1 - gain
+        return measured
@@ -0,0 +1,326 @@
+import heapq
+
+import numpy as np
+
+# Distance of cells that can't reach the goal (blocked, or walled off)
+UNREACHABLE = np.iinfo(np.int32).max
+
+# Moves to the four neighbouring cells, in the order the maze solvers try them
+MOVES = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+class OccupancyGrid:
+    """Grid of maze cells that are either free or blocked
+
+    Cells are (x, y) pairs. The cells are stored in a NumPy array indexed
+    [y][x], like the rows of strings the maze solvers used to build, and
+    are also numbered row by row (index = y * width + x) so the planners
+    can keep their bookkeeping in flat arrays.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.blocked = np.zeros((height, width), dtype=bool)
+
+    def in_bounds(self, cell):
+        x, y = cell
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def is_blocked(self, cell):
+        x, y = cell
+        return bool(self.blocked[y, x])
+
+    def block(self, cell):
+        """Mark a cell as blocked (e.g. when the sonar sees something in it)"""
+        x, y = cell
+        self.blocked[y, x] = True
+
+    def unblock(self, cell):
+        x, y = cell
+        self.blocked[y, x] = False
+
+    def index(self, cell):
+        x, y = cell
+        return y * self.width + x
+
+    def cell(self, index):
+        y, x = divmod(index, self.width)
+        return (x, y)
+
+    def neighbors(self, cell):
+        """Free cells next to cell, in MOVES order"""
+        x, y = cell
+        result = []
+        for dx, dy in MOVES:
+            neighbor = (x + dx, y + dy)
+            if self.in_bounds(neighbor) and not self.is_blocked(neighbor):
+                result.append(neighbor)
+        return result
+
+def distance_field(grid, goal):
+    """Number of moves from every cell to goal, found by breadth-first search
+
+    The search grows out from the goal one step at a time, handling the
+    whole frontier at once with NumPy, so even a 1000x1000 grid takes a
+    fraction of a second.
+
+    Returns: int32 array indexed [y][x], UNREACHABLE for cells that can't get to goal
+    """
+    width, height = grid.width, grid.height
+    size = width * height
+    distances = np.full(size, UNREACHABLE, dtype=np.int32)
+    free = ~grid.blocked.ravel()
+    goal_index = grid.index(goal)
+    if not free[goal_index]:
+        return distances.reshape(height, width)
+
+    distances[goal_index] = 0
+    frontier = np.array([goal_index])
+    step = 0
+    while frontier.size:
+        step += 1
+        x = frontier % width
+        candidates = np.concatenate((
+            frontier[x < width - 1] + 1,
+            frontier[x > 0] - 1,
+            frontier[frontier < size - width] + width,
+            frontier[frontier >= width] - width,
+        ))
+        candidates = candidates[free[candidates] & (distances[candidates] == UNREACHABLE)]
+        frontier = np.unique(candidates)
+        distances[frontier] = step
+    return distances.reshape(height, width)
+
+def path_from_field(grid, distances, start):
+    """Follow a distance_field downhill from start to its goal
+
+    Returns: list of cells from start to the goal (both included), or None if start can't reach it
+    """
+    if distances[start[1], start[0]] == UNREACHABLE:
+        return None
+    path = [start]
+    cell = start
+    while distances[cell[1], cell[0]] > 0:
+        here = distances[cell[1], cell[0]]
+        for neighbor in grid.neighbors(cell):
+            if distances[neighbor[1], neighbor[0]] == here - 1:
+                cell = neighbor
+                break
+        path.append(cell)
+    return path
+
+def bfs_path(grid, start, goal):
+    """Shortest path from start to goal (list of cells, both included), or None"""
+    return path_from_field(grid, distance_field(grid, goal), start)
+
+def astar_path(grid, start, goal):
+    """Shortest path from start to goal found with A*, or None
+
+    Only looks at cells that could be on a shortest path (guided by the
+    Manhattan distance to goal), so it is much quicker than bfs_path when
+    start and goal are close together on a big grid.
+    """
+    if grid.is_blocked(start) or grid.is_blocked(goal):
+        return None
+    width, height = grid.width, grid.height
+    blocked = grid.blocked.ravel()
+    goal_x, goal_y = goal
+    start_index = grid.index(start)
+    goal_index = grid.index(goal)
+
+    cost = {start_index: 0}
+    came_from = {start_index: None}
+    # Ties are broken towards the most moves made, so open areas are
+    # crossed in a straight line instead of being filled in
+    open_cells = [(abs(start[0] - goal_x) + abs(start[1] - goal_y), 0, start_index)]
+    while open_cells:
+        _, negative_cost, index = heapq.heappop(open_cells)
+        if -negative_cost > cost[index]:
+            continue  # Already reached more cheaply
+        if index == goal_index:
+            path = []
+            while index is not None:
+                path.append(grid.cell(index))
+                index = came_from[index]
+            return path[::-1]
+
+        y, x = divmod(index, width)
+        next_cost = cost[index] + 1
+        for dx, dy in MOVES:
+            nx, ny = x + dx, y + dy
+            if not (0 <= nx < width and 0 <= ny < height):
+                continue
+            neighbor = ny * width + nx
+            if blocked[neighbor] or cost.get(neighbor, next_cost + 1) <= next_cost:
+                continue
+            cost[neighbor] = next_cost
+            came_from[neighbor] = index
+            estimate = next_cost + abs(nx - goal_x) + abs(ny - goal_y)
+            heapq.heappush(open_cells, (estimate, -next_cost, neighbor))
+    return None
+
+class DStarLite:
+    """Shortest path to goal that is repaired, not recomputed, when cells get blocked
+
+    D* Lite (Koenig & Likhachev) searches backwards from the goal. Each
+    cell keeps its distance to the goal (g) and a one-step lookahead
+    (rhs). Blocking a cell only puts the cells whose distances it changes
+    back in the queue, so replanning costs about as much as the part of
+    the map that changed, not the whole grid. Distances are only stored
+    for cells the search has looked at (see distance()).
+
+    Use move_to() as the robot moves, block() when the sonar finds
+    something in a cell (and unblock() if it turns out not to be there),
+    and next_cell() to get the next cell to move to.
+    """
+
+    def __init__(self, grid, start, goal):
+        self.grid = grid
+        self.start = tuple(start)
+        self.goal = tuple(goal)
+        self.last_start = self.start
+        self.key_offset = 0  # km in the paper: how far the robot moved between replans
+        self.g = {}
+        self.rhs = {self.goal: 0}
+        self.queue = []
+        self.queued = {}  # cell -> key of its live queue entry (older entries are skipped)
+        self._push(self.goal)
+        self._compute()
+
+    @staticmethod
+    def _heuristic(a, b):
+        return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+    def _key(self, cell):
+        best = min(self.g.get(cell, np.inf), self.rhs.get(cell, np.inf))
+        return (best + self._heuristic(self.start, cell) + self.key_offset, best)
+
+    def _push(self, cell):
+        key = self._key(cell)
+        self.queued[cell] = key
+        heapq.heappush(self.queue, (key, cell))
+
+    def _around(self, cell):
+        """Cells next to cell that are on the grid, blocked or not"""
+        x, y = cell
+        return [(x + dx, y + dy) for dx, dy in MOVES if self.grid.in_bounds((x + dx, y + dy))]
+
+    def _update(self, cell):
+        if cell != self.goal:
+            if self.grid.is_blocked(cell):
+                self.rhs[cell] = np.inf
+            else:
+                self.rhs[cell] = min(
+                    (1 + self.g.get(neighbor, np.inf) for neighbor in self._around(cell)
+                     if not self.grid.is_blocked(neighbor)),
+                    default=np.inf,
+                )
+        if self.g.get(cell, np.inf) != self.rhs.get(cell, np.inf):
+            self._push(cell)
+        else:
+            self.queued.pop(cell, None)
+
+    def _top(self):
+        """Smallest live queue entry, or None"""
+        while self.queue:
+            key, cell = self.queue[0]
+            if self.queued.get(cell) == key:
+                return key, cell
+            heapq.heappop(self.queue)
+        return None
+
+    def _compute(self):
+        while True:
+            top = self._top()
+            start_g = self.g.get(self.start, np.inf)
+            start_rhs = self.rhs.get(self.start, np.inf)
+            if top is None or (top[0] >= self._key(self.start) and start_g == start_rhs):
+                return
+            old_key, cell = top
+            new_key = self._key(cell)
+            if old_key < new_key:
+                self._push(cell)
+            elif self.g.get(cell, np.inf) > self.rhs.get(cell, np.inf):
+                self.g[cell] = self.rhs[cell]
+                del self.queued[cell]
+                for neighbor in self._around(cell):
+                    self._update(neighbor)
+            else:
+                self.g[cell] = np.inf
+                self._update(cell)
+                for neighbor in self._around(cell):
+                    self._update(neighbor)
+
+    def move_to(self, cell):
+        """Tell the planner the robot is now in cell"""
+        self.start = tuple(cell)
+
+    def block(self, cell):
+        """Mark a cell as blocked and repair the paths that went through it"""
+        cell = tuple(cell)
+        if self.grid.is_blocked(cell):
+            return
+        self.grid.block(cell)
+        self.key_offset += self._heuristic(self.last_start, self.start)
+        self.last_start = self.start
+        self._update(cell)
+        for neighbor in self._around(cell):
+            self._update(neighbor)
+        self._compute()
+
+    def unblock(self, cell):
+        """Mark a blocked cell as free again (e.g. when the sonar sees through it) and repair the paths"""
+        cell = tuple(cell)
+        if not self.grid.is_blocked(cell):
+            return
+        self.grid.unblock(cell)
+        self.key_offset += self._heuristic(self.last_start, self.start)
+        self.last_start = self.start
+        self._update(cell)
+        for neighbor in self._around(cell):
+            self._update(neighbor)
+        self._compute()
+
+    def distance(self, cell):
+        """Moves from cell to the goal, never more than the real number
+
+        The search stops once it has found the robot's path, so it only
+        knows the exact distance for some cells: the ones it has settled
+        (g == rhs) with a key no bigger than anything left in the queue.
+        Every other cell gets the Manhattan distance, which is never too
+        big, so the result can guide an A* search (see
+        motion_plan.turn_weighted_path).
+
+        Returns: number of moves, or UNREACHABLE only if the cell is blocked
+        or the search has shown the goal can't be reached from it
+        """
+        cell = tuple(cell)
+        if self.grid.is_blocked(cell):
+            return UNREACHABLE
+        g = self.g.get(cell, np.inf)
+        top = self._top()
+        if g == self.rhs.get(cell, np.inf) and (top is None or self._key(cell) <= top[0]):
+            return UNREACHABLE if g == np.inf else int(g)
+        return self._heuristic(cell, self.goal)
+
+    def next_cell(self):
+        """Best cell to move to from the robot's cell, or None if the goal can't be reached"""
+        return self._best_neighbor(self.start)
+
+    def _best_neighbor(self, cell):
+        best = None
+        best_distance = np.inf
+        for neighbor in self.grid.neighbors(cell):
+            distance = 1 + self.g.get(neighbor, np.inf)
+            if distance < best_distance:
+                best, best_distance = neighbor, distance
+        return best
+
+    def path(self):
+        """Cells from the robot's cell to the goal (both included), or None"""
+        if self.g.get(self.start, np.inf) == np.inf:
+            return None
+        path = [self.start]
+        while path[-1] != self.goal:
+            path.append(self._best_neighbor(path[-1]))
+        return path
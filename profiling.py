@@ -0,0 +1,58 @@
+import time
+from collections import deque
+
+import numpy as np
+
+class FrameProfiler:
+    """Wall time of each stage of the simulator's frames, in ring buffers
+
+    The simulator calls mark() when a frame starts and lap(stage) after each
+    stage, so every stage's time is the time since the previous mark or lap.
+    Only the last `history` times of each stage are kept, so the profiler
+    can stay on for a whole run.
+
+    Parameters:
+    * history: how many times to keep for each stage
+    * clock: function returning the time in seconds
+
+    Example:
+    driver.start_profiling()
+    robot.motors(1, 1, 5)
+    print(driver.stats()["robot"]["p95"])
+    """
+
+    def __init__(self, history=300, clock=time.perf_counter):
+        self.history = history
+        self.clock = clock
+        self.times = {}  # stage -> deque of seconds, in the order the stages first ran
+        self.last = clock()
+
+    def mark(self):
+        """Start timing from now"""
+        self.last = self.clock()
+
+    def lap(self, stage):
+        """Record the time since the last mark() or lap() as one run of stage"""
+        now = self.clock()
+        times = self.times.get(stage)
+        if times is None:
+            times = self.times[stage] = deque(maxlen=self.history)
+        times.append(now - self.last)
+        self.last = now
+
+    def stats(self):
+        """p50, p95 and max time of each stage in milliseconds, and how many times are kept
+
+        Returns: dict like {"robot": {"p50": 0.2, "p95": 0.4, "max": 1.3, "count": 300}, ...}
+        """
+        result = {}
+        for stage, times in self.times.items():
+            milliseconds = np.array(times) * 1000
+            p50, p95 = np.percentile(milliseconds, (50, 95))
+            result[stage] = {"p50": float(p50), "p95": float(p95),
+                             "max": float(milliseconds.max()), "count": len(milliseconds)}
+        return result
+
+    def reset(self):
+        self.times = {}
+        self.last = self.clock()
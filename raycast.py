@@ -0,0 +1,103 @@
+import numpy as np
+
+class SegmentGrid:
+    """Uniform grid of line segments for fast ray casting
+
+    Every cell of the grid keeps a list of the segments that pass through
+    it, so a ray only tests the segments in the cells it walks through
+    instead of every segment in the arena.
+
+    Parameters:
+    * segments: list of (x1, y1, x2, y2) line segments in mm
+    * bounds: (min_x, min_y, max_x, max_y) of the area the grid covers
+    * cell_size: size of a grid cell in mm (picked from the segment count if None)
+    """
+
+    def __init__(self, segments, bounds, cell_size=None):
+        self.segments = [tuple(float(v) for v in segment) for segment in segments]
+        self.min_x, self.min_y, self.max_x, self.max_y = bounds
+        width = self.max_x - self.min_x
+        height = self.max_y - self.min_y
+
+        if cell_size is None:
+            # Aim for a couple of segments per cell
+            cell_size = np.sqrt(width * height / max(len(self.segments), 1)) * 1.5
+        self.cell_size = cell_size
+        self.columns = max(1, int(np.ceil(width / cell_size)))
+        self.rows = max(1, int(np.ceil(height / cell_size)))
+
+        self.cells = [[] for _ in range(self.columns * self.rows)]
+        for index, (x1, y1, x2, y2) in enumerate(self.segments):
+            first_column, first_row = self._cell_of(min(x1, x2), min(y1, y2))
+            last_column, last_row = self._cell_of(max(x1, x2), max(y1, y2))
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    self.cells[row * self.columns + column].append(index)
+
+    def _cell_of(self, x, y):
+        """Get the (column, row) of the cell containing a point, clamped to the grid"""
+        column = int((x - self.min_x) // self.cell_size)
+        row = int((y - self.min_y) // self.cell_size)
+        return min(max(column, 0), self.columns - 1), min(max(row, 0), self.rows - 1)
+
+    def cast(self, x, y, heading):
+        """Distance from (x, y) to the nearest segment in direction heading (degrees)
+
+        Returns: distance in mm, or infinity if the ray doesn't hit anything
+        """
+        dx = np.cos(np.radians(heading))
+        dy = np.sin(np.radians(heading))
+        # Segments in several cells are only tested once. This is local to
+        # the call so rays can be cast from several threads at once.
+        tested = set()
+
+        # Walk the cells along the ray (Amanatides & Woo grid traversal)
+        column, row = self._cell_of(x, y)
+        step_column = 1 if dx > 0 else -1
+        step_row = 1 if dy > 0 else -1
+        next_x = self.min_x + (column + (dx > 0)) * self.cell_size
+        next_y = self.min_y + (row + (dy > 0)) * self.cell_size
+        t_max_x = (next_x - x) / dx if dx != 0 else np.inf
+        t_max_y = (next_y - y) / dy if dy != 0 else np.inf
+        t_delta_x = self.cell_size / abs(dx) if dx != 0 else np.inf
+        t_delta_y = self.cell_size / abs(dy) if dy != 0 else np.inf
+
+        nearest = np.inf
+        while 0 <= column < self.columns and 0 <= row < self.rows:
+            for index in self.cells[row * self.columns + column]:
+                if index in tested:
+                    continue
+                tested.add(index)
+                t = self._intersect(x, y, dx, dy, self.segments[index])
+                if t < nearest:
+                    nearest = t
+
+            # A hit inside this cell can't be beaten by anything further along the ray
+            cell_exit = min(t_max_x, t_max_y)
+            if nearest <= cell_exit:
+                return nearest
+            if t_max_x < t_max_y:
+                column += step_column
+                t_max_x += t_delta_x
+            else:
+                row += step_row
+                t_max_y += t_delta_y
+        return nearest
+
+    @staticmethod
+    def _intersect(x, y, dx, dy, segment):
+        """Distance along the ray (x, y) + t * (dx, dy) to a segment, or infinity"""
+        x1, y1, x2, y2 = segment
+        ex = x2 - x1
+        ey = y2 - y1
+        denominator = dx * ey - dy * ex
+        if denominator == 0:
+            # Parallel to the segment
+            return np.inf
+        ox = x1 - x
+        oy = y1 - y
+        t = (ox * ey - oy * ex) / denominator
+        u = (ox * dy - oy * dx) / denominator
+        if t >= 0 and 0 <= u <= 1:
+            return t
+        return np.inf
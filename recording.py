@@ -0,0 +1,169 @@
+import json
+import math
+import random
+import time
+from collections import deque
+
+import numpy as np
+
+def seed_random(seed):
+    """Seed Python's and NumPy's random numbers, so random.randint() etc. repeat"""
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+
+class Recorder:
+    """Writes a robot session to a JSON-lines file, one event per line
+
+    Every line has the event name and the time in seconds since recording
+    started, e.g. {"event":"motors","t":1.5,"left":1,"right":1,"seconds":2}.
+    Lines are written as they happen, so the file is complete up to the
+    moment a program crashes.
+    """
+
+    def __init__(self, path, seed, **settings):
+        self.path = path
+        self.file = open(path, "w", buffering=1)
+        self.start = time.perf_counter()
+        self.write("start", seed=seed, **settings)
+
+    def write(self, event, **fields):
+        line = {"event": event, "t": round(time.perf_counter() - self.start, 6)}
+        line.update(fields)
+        # default=float writes NumPy numbers as plain numbers
+        self.file.write(json.dumps(line, separators=(",", ":"), default=float) + "\n")
+
+    def close(self):
+        self.file.close()
+
+def load_recording(path):
+    """Read the events of a recording, oldest first"""
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+class ReplayDriver:
+    """Plays back a recorded session on a headless simulator
+
+    Use run() to re-execute every recorded motor command at full speed and
+    compare the simulator's poses with the recorded ones (if the recording
+    was made on the simulator). A command that crashed when it was
+    recorded raises the same exception again.
+
+    Or pass it to Robot(driver=...) to rerun the program that made the
+    recording: the sonars return the recorded readings in order (so the
+    program makes the same decisions, even with readings from the real
+    robot) and the motors move the simulator.
+
+    Parameters:
+    * path: the recording (see Robot.start_recording)
+    * simulator: driver to move (a headless SimulatorDriver set up like the recorded one if None)
+    """
+
+    def __init__(self, path, simulator=None):
+        self.events = load_recording(path)
+        header = self.events[0]
+        seed_random(header["seed"])
+        if simulator is None:
+            from simulator import SimulatorDriver
+            simulator = SimulatorDriver(n_obstacles=header.get("n_obstacles"),
+                                        randomize_obstacles=header.get("randomize_obstacles"), headless=True)
+        if header.get("pose") is not None:
+            simulator.x, simulator.y, simulator.heading = header["pose"]
+        self.simulator = simulator
+        self.time_scale = header.get("time_scale", 1)
+        self.sonar_readings = {"left": deque(), "right": deque()}
+        for event in self.events:
+            if event["event"] == "sonar":
+                self.sonar_readings[event["side"]].append(event["distance"])
+
+    def run(self, tolerance=1e-6):
+        """Re-execute the recorded motor commands and compare poses
+
+        Returns: list of (event number, recorded (x, y, heading), replayed
+        (x, y, heading)) for every pose that is more than tolerance mm or
+        degrees off
+        """
+        simulator = self.simulator
+        mismatches = []
+        running = None  # start_motors event that hasn't been stopped yet
+
+        for number, event in enumerate(self.events):
+            kind = event["event"]
+            if running is not None and kind in ("motors", "start_motors", "stop", "trajectory"):
+                if event.get("ran") is not None:
+                    # Simulated time the command ran for, recorded when it was stopped
+                    seconds = event["ran"]
+                else:
+                    # Only the wall time between the events (a command that finished by
+                    # itself, or a recording from the real robot)
+                    seconds = (event["t"] - running["t"]) * self.time_scale
+                    if running["seconds"] is not None:
+                        seconds = min(seconds, running["seconds"])
+                simulator.motors(running["left"], running["right"], seconds)
+                running = None
+
+            if kind == "motors":
+                simulator.motors(event["left"], event["right"], event["seconds"])
+            elif kind == "start_motors":
+                running = event
+            elif kind == "trajectory":
+                simulator.run_trajectory(event["segments"])
+            elif kind == "pose":
+                recorded = (event["x"], event["y"], event["heading"])
+                replayed = (float(simulator.x), float(simulator.y), float(simulator.heading))
+                heading_error = abs((replayed[2] - recorded[2] + 180) % 360 - 180)
+                if (math.hypot(replayed[0] - recorded[0], replayed[1] - recorded[1]) > tolerance
+                        or heading_error > tolerance):
+                    mismatches.append((number, recorded, replayed))
+
+        if running is not None and running["seconds"] is not None:
+            simulator.motors(running["left"], running["right"], running["seconds"])
+        return mismatches
+
+    # Driver functions, for Robot(driver=ReplayDriver(...))
+
+    def motors(self, left, right, seconds):
+        self.simulator.motors(left, right, seconds)
+
+    def start_motors(self, left, right, seconds=None):
+        self.simulator.start_motors(left, right, seconds)
+
+    def stop(self):
+        return self.simulator.stop()
+
+    def is_moving(self):
+        return self.simulator.is_moving()
+
+    def update(self):
+        self.simulator.update()
+
+    def run_trajectory(self, segments, on_progress=None):
+        return self.simulator.run_trajectory(segments, on_progress)
+
+    def left_sonar(self):
+        if self.sonar_readings["left"]:
+            return self.sonar_readings["left"].popleft()
+        return self.simulator.left_sonar()
+
+    def right_sonar(self):
+        if self.sonar_readings["right"]:
+            return self.sonar_readings["right"].popleft()
+        return self.simulator.right_sonar()
+
+    def sonars(self):
+        return self.left_sonar(), self.right_sonar()
+
+    @property
+    def sampler(self):
+        return self.simulator.sampler
+
+    def start_sonar_sampler(self, rate=20, history=100):
+        self.simulator.start_sonar_sampler(rate=rate, history=history)
+
+    def stop_sonar_sampler(self):
+        self.simulator.stop_sonar_sampler()
+
+    def sonar_history(self, side, n=None):
+        return self.simulator.sonar_history(side, n)
+
+    def exit(self):
+        self.simulator.exit()
@@ -1,10 +1,89 @@
-import RPi.GPIO as GPIO
+import threading
 import time
 
+from sonar import SonarSampler
+from telemetry import ECHO_FALL, ECHO_RISE, MOTOR_OFF, MOTOR_ON, SONAR_TIMEOUT, SONAR_TRIGGER
+
+# RPi.GPIO, or a stand-in with the same functions (for testing off the Pi).
+# Set when the RealRobotDriver is created.
+GPIO = None
+
+# Sonar reading when no echo comes back before the timeout (nothing in range)
+NO_ECHO = float("inf")
+
+# Speed of sound in cm/s
+SPEED_OF_SOUND = 34300
+
+# How many times a second the motor speed pins switch on and off (Hz)
+PWM_FREQUENCY = 1000
+
+class PigpioPWM:
+    """Drives a speed pin like RPi.GPIO's PWM objects, but with pulses timed by pigpio's DMA
+
+    RPi.GPIO times its PWM pulses with a software thread, which jitters
+    whenever Python is busy. pigpio (run `sudo pigpiod` first) has the DMA
+    hardware time them instead. The Pi's real PWM peripheral isn't used:
+    GPIO 12 and 18 are both on its channel PWM0, so they would always get
+    the same duty cycle and the wheels couldn't run at different powers.
+
+    Parameters:
+    * pi: a connected pigpio.pi()
+    * pin: BCM pin number
+    * frequency: pulses per second
+    """
+
+    def __init__(self, pi, pin, frequency):
+        self.pi = pi
+        self.pin = pin
+        pi.set_PWM_frequency(pin, frequency)
+        pi.set_PWM_range(pin, 10000)  # duty cycle in hundredths of a percent
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.pi.set_PWM_dutycycle(self.pin, round(duty_cycle * 100))
+
+    def stop(self):
+        self.pi.set_PWM_dutycycle(self.pin, 0)
+
+def connect_pigpio():
+    """A connected pigpio.pi(), or None if pigpio isn't installed or its daemon isn't running"""
+    try:
+        import pigpio
+    except ImportError:
+        return None
+    pi = pigpio.pi()
+    if not pi.connected:
+        return None
+    return pi
+
 # Real Robot Driver
 class RealRobotDriver:
-    def __init__(self):
+    def __init__(self, gpio=None, max_range=400, clock=time.perf_counter, telemetry=None, pwm_pi=None):
+        """
+        Parameters:
+        * gpio: the GPIO module to use (RPi.GPIO if None)
+        * pwm_pi: a pigpio.pi() (or a stand-in) to time the motor PWM with.
+          If None and gpio is None, pigpio is used if its daemon is running,
+          otherwise RPi.GPIO's software PWM.
+        * max_range: furthest sonar reading in cm, anything further reads as NO_ECHO
+        * clock: function returning the time in seconds, used to time echoes
+        * telemetry: a telemetry.GpioTelemetry to timestamp every motor and
+          sonar edge into (nothing is recorded if None)
+        """
+        global GPIO
         print("robot driver initializing...") 
+        if gpio is None:
+            import RPi.GPIO as gpio
+            if pwm_pi is None:
+                pwm_pi = connect_pigpio()
+                if pwm_pi is None:
+                    print("pigpio isn't running, using software PWM (start it with `sudo pigpiod`)")
+        GPIO = gpio
+        self.clock = clock
+        self.telemetry = telemetry
+
         #GPIO Mode (BOARD / BCM)
         GPIO.setmode(GPIO.BCM)
 
@@ -35,79 +114,243 @@ class RealRobotDriver:
         GPIO.setup(self.GPIO_RIGHT_MOTOR_BLUE, GPIO.OUT)
         GPIO.setup(self.GPIO_RIGHT_MOTOR_ORANGE, GPIO.OUT)
 
+        # The speed pins are switched on and off quickly (PWM). The fraction
+        # of the time they are on (the duty cycle) sets the motor power.
+        # pigpio times the pulses with DMA when it's available (see PigpioPWM).
+        self.pwm_pi = pwm_pi
+        self.speed_pwm = {}
+        for speed_pin in (self.GPIO_LEFT_MOTOR_SPEED, self.GPIO_RIGHT_MOTOR_SPEED):
+            if pwm_pi is not None:
+                self.speed_pwm[speed_pin] = PigpioPWM(pwm_pi, speed_pin, PWM_FREQUENCY)
+            else:
+                self.speed_pwm[speed_pin] = GPIO.PWM(speed_pin, PWM_FREQUENCY)
+            self.speed_pwm[speed_pin].start(0)
+
+        # Echo pulses are timed by GPIO edge interrupts instead of busy-waiting.
+        # A reading gives up after the round trip time to max_range (plus a
+        # little slack for the sensor to start its pulse).
+        self.max_range = max_range
+        self.sonar_timeout = 2 * max_range / SPEED_OF_SOUND + 0.005
+        self.echo_rise = {}
+        self.echo_fall = {}
+        self.echo_done = {}
+        for echo in (self.GPIO_LEFT_ECHO, self.GPIO_RIGHT_ECHO):
+            self.echo_rise[echo] = None
+            self.echo_fall[echo] = None
+            self.echo_done[echo] = threading.Event()
+            GPIO.add_event_detect(echo, GPIO.BOTH, callback=self._echo_edge)
+
+        # Background pinging, see start_sonar_sampler()
+        self.sampler = None
+
+        # Timer that stops the motors at the end of a start_motors() command.
+        # The lock keeps the timer thread and the main thread from setting
+        # the motor pins at the same time.
+        self.stop_timer = None
+        self.moving = False
+        self.motor_lock = threading.Lock()
+
     def left_sonar(self):
+        # While the sampler runs it is the only thing that pings, so the two
+        # never overwrite each other's echo times
+        distance = None if self.sampler is None else self.sampler.read('left')
+        if distance is not None:
+            return distance
         return self.sonar(self.GPIO_LEFT_TRIGGER, self.GPIO_LEFT_ECHO)
     
     def right_sonar(self):
+        distance = None if self.sampler is None else self.sampler.read('right')
+        if distance is not None:
+            return distance
         return self.sonar(self.GPIO_RIGHT_TRIGGER, self.GPIO_RIGHT_ECHO)
 
     def sonars(self):
-        left_distance = self.sonar(self.GPIO_LEFT_TRIGGER, self.GPIO_LEFT_ECHO)
-        right_distance = self.sonar(self.GPIO_RIGHT_TRIGGER, self.GPIO_RIGHT_ECHO)
+        left_distance = self.left_sonar()
+        right_distance = self.right_sonar()
         return left_distance, right_distance
 
+    def start_sonar_sampler(self, rate=20, history=100):
+        # Ping the sonars in turn on a background thread, so left_sonar() and
+        # right_sonar() return the latest reading right away
+        self.stop_sonar_sampler()
+        self.sampler = SonarSampler(
+            lambda: self.sonar(self.GPIO_LEFT_TRIGGER, self.GPIO_LEFT_ECHO),
+            lambda: self.sonar(self.GPIO_RIGHT_TRIGGER, self.GPIO_RIGHT_ECHO),
+            rate=rate, history=history, clock=self.clock
+        )
+        self.sampler.start()
+
+    def stop_sonar_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def sonar_history(self, side, n=None):
+        if self.sampler is None:
+            return []
+        return self.sampler.history(side, n)
+
+    def _echo_edge(self, channel):
+        # Called from the GPIO interrupt thread on every change of an echo pin
+        now = self.clock()
+        if GPIO.input(channel):
+            self.echo_rise[channel] = now
+            if self.telemetry is not None:
+                self.telemetry.record(ECHO_RISE, channel)
+        elif self.echo_rise[channel] is not None:
+            self.echo_fall[channel] = now
+            self.echo_done[channel].set()
+            if self.telemetry is not None:
+                self.telemetry.record(ECHO_FALL, channel)
+
     def sonar(self, GPIO_TRIGGER, GPIO_ECHO):
+        self.echo_rise[GPIO_ECHO] = None
+        self.echo_fall[GPIO_ECHO] = None
+        self.echo_done[GPIO_ECHO].clear()
+
         # set Trigger to HIGH
         GPIO.output(GPIO_TRIGGER, True)
+        if self.telemetry is not None:
+            self.telemetry.record(SONAR_TRIGGER, GPIO_ECHO)
 
         # set Trigger after 0.01ms to LOW
         time.sleep(0.00001)
         GPIO.output(GPIO_TRIGGER, False)
 
-        StartTime = time.time()
-        StopTime = time.time()
-
-        # save StartTime
-        while GPIO.input(GPIO_ECHO) == 0:
-            StartTime = time.time()
-            #print(f"{StartTime=}")
-
-        # save time of arrival
-        while GPIO.input(GPIO_ECHO) == 1:
-            StopTime = time.time()
-            #print(f"{StopTime=}")
+        # wait for the echo pin to go up and back down, or give up
+        if not self.echo_done[GPIO_ECHO].wait(self.sonar_timeout):
+            if self.telemetry is not None:
+                self.telemetry.record(SONAR_TIMEOUT, GPIO_ECHO)
+            return NO_ECHO
 
         # time difference between start and arrival
-        TimeElapsed = StopTime - StartTime
+        TimeElapsed = self.echo_fall[GPIO_ECHO] - self.echo_rise[GPIO_ECHO]
         # multiply with the sonic speed (34300 cm/s)
         # and divide by 2, because there and back
-        distance = (TimeElapsed * 34300) / 2
+        distance = (TimeElapsed * SPEED_OF_SOUND) / 2
 
+        if distance > self.max_range:
+            return NO_ECHO
         return distance
     
     def stop(self):
+        with self.motor_lock:
+            if self.stop_timer is not None:
+                self.stop_timer.cancel()
+                self.stop_timer = None
+            self.moving = False
+            self._stop_pins()
+
+    def _stop_pins(self):
         GPIO.output(self.GPIO_LEFT_MOTOR_BLUE, GPIO.LOW)
         GPIO.output(self.GPIO_LEFT_MOTOR_ORANGE, GPIO.LOW)
-        GPIO.output(self.GPIO_LEFT_MOTOR_SPEED, GPIO.LOW)
+        self.speed_pwm[self.GPIO_LEFT_MOTOR_SPEED].ChangeDutyCycle(0)
         GPIO.output(self.GPIO_RIGHT_MOTOR_BLUE, GPIO.LOW)
         GPIO.output(self.GPIO_RIGHT_MOTOR_ORANGE, GPIO.LOW)
-        GPIO.output(self.GPIO_RIGHT_MOTOR_SPEED, GPIO.LOW)
+        self.speed_pwm[self.GPIO_RIGHT_MOTOR_SPEED].ChangeDutyCycle(0)
         GPIO.output(self.GPIO_LEFT_TRIGGER, GPIO.LOW)
         GPIO.output(self.GPIO_RIGHT_TRIGGER, GPIO.LOW)
+        if self.telemetry is not None:
+            self.telemetry.record(MOTOR_OFF)
 
     def motor(self, velocity, speed_pin, blue_pin, orange_pin):
+        # velocity goes from -1 (full backward) to 1 (full forward)
         if velocity == 0:
             GPIO.output(blue_pin, GPIO.LOW)
             GPIO.output(orange_pin, GPIO.LOW)
-            GPIO.output(speed_pin, GPIO.LOW)
         elif velocity > 0:
             GPIO.output(blue_pin, GPIO.HIGH)
             GPIO.output(orange_pin, GPIO.LOW)
-            GPIO.output(speed_pin, GPIO.HIGH)
         else:
             GPIO.output(blue_pin, GPIO.LOW)
             GPIO.output(orange_pin, GPIO.HIGH)
-            GPIO.output(speed_pin, GPIO.HIGH)
+        self.speed_pwm[speed_pin].ChangeDutyCycle(abs(velocity) * 100)
+
+    def _check_powers(self, left, right):
+        for power in (left, right):
+            if not -1 <= power <= 1:
+                raise Exception(
+                    "Ooops! Dr. Ebee's motors only go from BACKWARD (-1) to FORWARD (1). "
+                    "Use a number in between (like 0.5 for half power) as "
+                    "input to the `motors` function!!"
+                )
     
     def motors(self, left, right, seconds):
         # Call real robot hardware control for left motor
         #self.robot_hardware.set_left_motor_speed(left)
         #self.robot_hardware.set_right_motor_speed(right)
-        self.motor(left, self.GPIO_LEFT_MOTOR_SPEED, self.GPIO_LEFT_MOTOR_BLUE, self.GPIO_LEFT_MOTOR_ORANGE)
-        self.motor(right, self.GPIO_RIGHT_MOTOR_SPEED, self.GPIO_RIGHT_MOTOR_BLUE, self.GPIO_RIGHT_MOTOR_ORANGE)
+        self._check_powers(left, right)
+        self.stop()
+        with self.motor_lock:
+            self.motor(left, self.GPIO_LEFT_MOTOR_SPEED, self.GPIO_LEFT_MOTOR_BLUE, self.GPIO_LEFT_MOTOR_ORANGE)
+            self.motor(right, self.GPIO_RIGHT_MOTOR_SPEED, self.GPIO_RIGHT_MOTOR_BLUE, self.GPIO_RIGHT_MOTOR_ORANGE)
+            if self.telemetry is not None:
+                self.telemetry.record(MOTOR_ON, value=seconds)
         time.sleep(seconds)
         self.stop()
 
+    def run_trajectory(self, segments, on_progress=None):
+        # Run (left, right, seconds) segments back to back. The pins go
+        # straight from one segment's power to the next without stopping,
+        # and each segment ends at a deadline counted from the start, so
+        # the time spent setting pins and reporting progress doesn't add up.
+        for left, right, seconds in segments:
+            self._check_powers(left, right)
+        self.stop()
+        start = time.perf_counter()
+        deadline = start
+        try:
+            for index, (left, right, seconds) in enumerate(segments):
+                with self.motor_lock:
+                    self.motor(left, self.GPIO_LEFT_MOTOR_SPEED, self.GPIO_LEFT_MOTOR_BLUE, self.GPIO_LEFT_MOTOR_ORANGE)
+                    self.motor(right, self.GPIO_RIGHT_MOTOR_SPEED, self.GPIO_RIGHT_MOTOR_BLUE, self.GPIO_RIGHT_MOTOR_ORANGE)
+                    if self.telemetry is not None:
+                        self.telemetry.record(MOTOR_ON, value=seconds)
+                deadline += seconds
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if on_progress is not None:
+                    on_progress(index + 1, len(segments))
+        finally:
+            self.stop()
+        return time.perf_counter() - start
+
+    def start_motors(self, left, right, seconds=None):
+        # Same as motors() but returns right away; a timer thread calls stop()
+        # after seconds (or never, if seconds is None)
+        self._check_powers(left, right)
+        self.stop()
+        with self.motor_lock:
+            self.motor(left, self.GPIO_LEFT_MOTOR_SPEED, self.GPIO_LEFT_MOTOR_BLUE, self.GPIO_LEFT_MOTOR_ORANGE)
+            self.motor(right, self.GPIO_RIGHT_MOTOR_SPEED, self.GPIO_RIGHT_MOTOR_BLUE, self.GPIO_RIGHT_MOTOR_ORANGE)
+            self.moving = True
+            if self.telemetry is not None:
+                self.telemetry.record(MOTOR_ON, value=float("nan") if seconds is None else seconds)
+            if seconds is not None:
+                self.stop_timer = threading.Timer(seconds, self._timer_stop)
+                self.stop_timer.daemon = True
+                self.stop_timer.start()
+
+    def _timer_stop(self):
+        with self.motor_lock:
+            if self.stop_timer is not threading.current_thread():
+                # A newer command replaced this timer while it was firing
+                return
+            self.stop_timer = None
+            self.moving = False
+            self._stop_pins()
+
+    def is_moving(self):
+        return self.moving
+
+    def update(self):
+        # The hardware moves by itself, there is nothing to catch up on
+        return
+
     def exit(self):
+        self.stop_sonar_sampler()
         self.stop()
+        if self.telemetry is not None and self.telemetry.path is not None:
+            self.telemetry.save()
         return
@@ -1,8 +1,24 @@
-import pygame
+import asyncio
 import os
+import math
 import numpy as np
+import random
 import sys
+import threading
 import time
+from collections import OrderedDict
+
+from calibration import load_profile, wall_angle
+from motion_plan import drive_model, normalize_angle, spin_segment
+from odometry import PoseEstimator
+from profiling import FrameProfiler
+from raycast import SegmentGrid
+from recording import Recorder, seed_random
+from sonar import SonarSampler
+
+# pygame is only imported when a simulator window is opened (see _import_pygame),
+# so headless runs and the real robot don't have to load it
+pygame = None
 
 # Motor power constants - use these with the motors() function
 FORWARD = 1
@@ -13,6 +29,13 @@ debug = False
 mode = "obstacles"
 frame = 0
 
+def _import_pygame():
+    global pygame
+    if pygame is None:
+        import pygame as pygame_module
+        pygame = pygame_module
+    return pygame
+
 def sin(degrees):
     return np.sin(np.radians(degrees))
 
@@ -43,18 +66,46 @@ def add_border(surface, color=(0, 0, 0), thickness=3):
     return new_surface
 
 class Robot:
-    def __init__(self, use_simulator = True, n_obstacles = None, randomize_obstacles = None):
-        if use_simulator:
-            self.driver = SimulatorDriver(n_obstacles = n_obstacles, randomize_obstacles = randomize_obstacles)
+    def __init__(self, use_simulator = True, n_obstacles = None, randomize_obstacles = None, headless = False,
+                 driver = None):
+        if driver is not None:
+            self.driver = driver  # e.g. a ReplayDriver from recording.py
+        elif use_simulator:
+            self.driver = SimulatorDriver(n_obstacles = n_obstacles, randomize_obstacles = randomize_obstacles, headless = headless)
         else:
-            self.driver = RealRobotDriver()  # driver can be a simulator or real robot
+            from robot import RealRobotDriver  # only needed (and only works) on the Pi
+            telemetry = None
+            if os.environ.get("ROBOT_TELEMETRY"):
+                from telemetry import GpioTelemetry
+                telemetry = GpioTelemetry(path=os.environ["ROBOT_TELEMETRY"])
+            self.driver = RealRobotDriver(telemetry=telemetry)  # driver can be a simulator or real robot
+
+        # Sonar filtering, see set_sonar_filter()
+        self.sonar_filters = None
+        self.filtered = {'left': None, 'right': None}
+        self.sample_count = {'left': 0, 'right': 0}  # background readings already filtered
+        # How fast the robot drives straight at full power, used to tell the
+        # sonar filters how far the robot moved (main.py measured 60 mm/s)
+        self.cm_per_second = 6
+        # How fast the robot spins in place at full power (0.98 degrees per frame at 60 fps)
+        self.degrees_per_second = 58.8
+        # Where the robot thinks it is, from its motor commands and sonars
+        self.odometry = PoseEstimator(self.cm_per_second, self.degrees_per_second)
+        # The speeds are replaced by the ones calibrate.py measured, see load_profile()
+        self.profile = None
+        self.load_profile()
+        # Running start_motors() command, for the sonar filters and odometry
+        self.command = None
+        # See start_recording()
+        self.recorder = None
 
     def motors(self, left, right, seconds):
         """Control the robot's wheels
         
         Parameters:
-        * left: power for the LEFT wheel (use FORWARD, BACKWARD, or STOP)
-        * right: power for the RIGHT wheel (use FORWARD, BACKWARD, or STOP)
+        * left: power for the LEFT wheel (use FORWARD, BACKWARD, or STOP,
+          or any number in between, like 0.5 for half speed forward)
+        * right: power for the RIGHT wheel (same as left)
         * seconds: how long to run the motors (can be a decimal like 0.5)
         
         Examples:
@@ -70,37 +121,442 @@ class Robot:
             # Spin right in place for 0.5 seconds
             robot.motors(left=FORWARD, right=BACKWARD, seconds=0.5)
             
+            # Creep forward at a quarter speed for 1 second
+            robot.motors(left=0.25, right=0.25, seconds=1)
+            
             # Stop both wheels
             robot.motors(left=STOP, right=STOP, seconds=0.1)
         """
+        self._settle_command()
+        self._record('motors', left=left, right=right, seconds=seconds, **self._end_command())
         self.driver.motors(left, right, seconds)
+        self._record_pose()
+        self._predict_motion(left, right, seconds)
+
+    def start_motors(self, left, right, seconds=None):
+        """Start the robot's wheels and return right away, without waiting
+        
+        The wheels keep turning while your code does other things (like
+        reading the sonars) until `seconds` have passed, robot.stop() is
+        called, or another motors command is given.
+        
+        Parameters: same as motors(). Leave out seconds to keep going until stop().
+        
+        In the simulator, the robot only moves (and the window only redraws)
+        when your code calls the robot, e.g. is_moving() or a sonar. So keep
+        calling it while you wait instead of using time.sleep(), or the
+        window freezes until the sleep is over. The real robot doesn't mind.
+        
+        Example:
+            robot.start_motors(left=FORWARD, right=FORWARD)
+            while robot.left_sonar() > 20:
+                pass
+            robot.stop()
+            
+            # Wait for a timed command to finish
+            robot.start_motors(left=FORWARD, right=BACKWARD, seconds=2)
+            while robot.is_moving():
+                pass
+        """
+        self._settle_command()
+        self._record('start_motors', left=left, right=right, seconds=seconds, **self._end_command())
+        self.driver.start_motors(left, right, seconds)
+        self.command = {
+            'left': left,
+            'right': right,
+            'start': time.perf_counter(),
+            'seconds': math.inf if seconds is None else seconds,
+            'predicted': 0,  # seconds of the command already told to the filters and odometry
+        }
+
+    def run_trajectory(self, segments, on_progress=None):
+        """Run a list of motor commands back to back
+        
+        Unlike calling motors() once per command, the robot doesn't stop
+        between commands, and nothing needs to sleep in between.
+        
+        Parameters:
+        * segments: list of (left, right, seconds) commands, like the
+          arguments of motors(). See waypoint_segments() to make them from
+          points to drive to.
+        * on_progress: function called as on_progress(done, total) after
+          each segment, where done is how many segments have finished
+        
+        Returns: how long the whole trajectory took in the robot's seconds:
+        wall-clock time on the real robot, simulated time in the simulator
+        (so it doesn't depend on time_scale or how fast the computer is)
+        
+        Example:
+            # Drive forward, spin for a bit, then drive forward again
+            robot.run_trajectory([(FORWARD, FORWARD, 2), (FORWARD, BACKWARD, 1), (FORWARD, FORWARD, 2)])
+        """
+        segments = [tuple(segment) for segment in segments]
+        self._settle_command()
+        ended = self._end_command()
+        self.command = None
+
+        def segment_done(done, total):
+            self._predict_motion(*segments[done - 1])
+            if on_progress is not None:
+                on_progress(done, total)
+
+        self._record('trajectory', segments=segments, **ended)
+        elapsed = self.driver.run_trajectory(segments, segment_done)
+        self._record_pose()
+        return elapsed
+
+    def waypoint_segments(self, waypoints):
+        """Turn a list of (x, y) points into segments for run_trajectory()
+        
+        The points are in cm, measured from where the robot is now, with
+        the robot facing along the x axis. To reach each point the robot
+        spins in place to face it, then drives straight to it, using
+        cm_per_second and degrees_per_second to work out the times.
+        
+        Example:
+            # Drive a 20 cm square
+            robot.run_trajectory(robot.waypoint_segments([(20, 0), (20, 20), (0, 20), (0, 0)]))
+        """
+        segments = []
+        x, y, heading = 0, 0, 0
+        for next_x, next_y in waypoints:
+            distance = math.hypot(next_x - x, next_y - y)
+            if distance == 0:
+                continue
+            # Spin the short way round to face the point
+            bearing = math.degrees(math.atan2(next_y - y, next_x - x))
+            spin = spin_segment(normalize_angle(bearing - heading), self.degrees_per_second)
+            if spin is not None:
+                segments.append(spin)
+            segments.append((FORWARD, FORWARD, distance / self.cm_per_second))
+            x, y, heading = next_x, next_y, bearing
+        return segments
+
+    def load_profile(self, path=None):
+        """Use the speeds calibrate.py measured and saved (in robot_profile.json)
+
+        A profile is only used by the kind of robot it was measured on, so
+        the simulator never drives at the real robot's speeds.
+
+        Parameters:
+        * path: profile file (the ROBOT_PROFILE environment variable, or robot_profile.json, if None)
+
+        Returns: True if a profile was loaded
+        """
+        profile = load_profile(path)
+        if profile is None or profile.get("driver") != type(self.driver).__name__:
+            return False
+        self.profile = profile
+        self.cm_per_second = profile["cm_per_second"]
+        self.degrees_per_second = profile["degrees_per_second"]
+        self.odometry.cm_per_second = self.cm_per_second
+        self.odometry.degrees_per_second = self.degrees_per_second
+        return True
+
+    def update_heading(self):
+        """Correct robot.odometry's heading with the angle to the wall in front, if the sonars both see one
+
+        Returns: the heading measured from the sonars, or None
+        """
+        return self.odometry.update(self.left_sonar(), self.right_sonar())
+
+    def turn(self, angle, tolerance=1, max_corrections=3, margin=0.2, creep=5):
+        """Spin in place by angle degrees (positive is counter-clockwise), stopping on what the sonars measure
+
+        If the robot will end up facing a wall, it spins for `margin` less
+        than degrees_per_second says (so it stops short even if it turns
+        faster than calibrated), then creeps on creep degrees at a time
+        until both sonars see the wall. From there the angle to the wall
+        says how far off it is, and it makes small correcting spins until
+        it is within tolerance degrees (or has tried max_corrections
+        times). Facing somewhere without a wall, it is just a timed spin.
+
+        Returns: the heading robot.odometry ends up with
+
+        Example:
+            # Turn around to face the wall behind
+            robot.turn(180)
+        """
+        odometry = self.odometry
+        target = odometry.heading + angle
+        to_wall = min(abs(normalize_angle(target - wall)) for wall in odometry.wall_headings)
+        if to_wall > odometry.max_wall_angle:
+            self._spin(angle)
+            return odometry.heading
+
+        self._spin(angle * (1 - margin))
+        step = creep if angle > 0 else -creep
+        previous = None
+        for _ in range(math.ceil((abs(angle) * margin + odometry.max_wall_angle) / creep) + 1):
+            left, right = self.left_sonar(), self.right_sonar()
+            measured = odometry.measured_heading(left, right)
+            # Near a corner one sonar can see the side wall and fake a
+            # straight-on reading, so only trust the wall once two readings
+            # in a row moved by about the creep
+            if (measured is not None and previous is not None
+                    and abs(normalize_angle(measured - previous) - step) <= creep / 2):
+                odometry.update(left, right)
+                break
+            previous = measured
+            self._spin(step)
+        else:
+            return odometry.heading  # never saw the wall
+
+        for _ in range(max_corrections):
+            error = normalize_angle(target - odometry.heading)
+            if abs(error) <= tolerance:
+                break
+            self._spin(error)
+            if self.update_heading() is None:
+                break
+        return odometry.heading
+
+    def align_to_wall(self, tolerance=1, max_corrections=5):
+        """Spin until the robot faces the wall in front straight on
+
+        Returns: the angle to the wall that is left, or None if the sonars don't both see a wall
+        """
+        for _ in range(max_corrections + 1):
+            left, right = self.left_sonar(), self.right_sonar()
+            if self.odometry.update(left, right) is None:
+                return None
+            angle = wall_angle(left, right, self.odometry.baseline)
+            if abs(angle) <= tolerance:
+                break
+            self._spin(-angle)
+        return angle
+
+    def _spin(self, angle):
+        spin = spin_segment(normalize_angle(angle), self.degrees_per_second)
+        if spin is not None:
+            self.motors(*spin)
+
+    def stop(self):
+        """Stop both wheels right away"""
+        self._record('stop', **self._end_command())
+        self.driver.stop()
+        self._record_pose()
+        self._settle_command()
+
+    def is_moving(self):
+        """Check if a command from start_motors() is still running"""
+        moving = self.driver.is_moving()
+        self._settle_command()
+        return moving
+
+    async def drive(self, left, right, seconds, poll_interval=0.005):
+        """Like motors(), but lets other asyncio tasks run while the robot drives
+        
+        Example:
+            async def watch_sonar():
+                while robot.is_moving():
+                    print(robot.left_sonar())
+                    await asyncio.sleep(0.05)
+            
+            async def main():
+                await asyncio.gather(robot.drive(FORWARD, FORWARD, 2), watch_sonar())
+            
+            asyncio.run(main())
+        """
+        self.start_motors(left, right, seconds)
+        try:
+            while self.driver.is_moving():
+                await asyncio.sleep(poll_interval)
+        finally:
+            self.stop()
     
     def left_sonar(self):
         """Read the distance from the left sonar sensor
         
-        Returns: distance to the nearest object in centimeters (cm)
+        Returns: distance to the nearest object in centimeters (cm), or
+        float("inf") if the real robot's sonar hears no echo (nothing in range)
         
         Example:
             distance = robot.left_sonar()
             if distance < 10:
                 print("Something is close on the left!")
         """
-        return self.driver.left_sonar()
+        distance = self.driver.left_sonar()
+        self._record('sonar', side='left', distance=distance)
+        return self._filter_sonar('left', distance)
     
     def right_sonar(self):
         """Read the distance from the right sonar sensor
         
-        Returns: distance to the nearest object in centimeters (cm)
+        Returns: distance to the nearest object in centimeters (cm), or
+        float("inf") if the real robot's sonar hears no echo (nothing in range)
         
         Example:
             distance = robot.right_sonar()
             if distance < 10:
                 print("Something is close on the right!")
         """
-        return self.driver.right_sonar()
+        distance = self.driver.right_sonar()
+        self._record('sonar', side='right', distance=distance)
+        return self._filter_sonar('right', distance)
     
+    def start_sonar_sampler(self, rate=20, history=100):
+        """Keep pinging both sonars in the background
+        
+        After this, left_sonar() and right_sonar() return the latest
+        background reading right away instead of waiting for a new ping.
+        
+        Parameters:
+        * rate: pings per second, shared by the two sonars (they take turns
+          so they don't hear each other's echoes)
+        * history: how many readings to keep for sonar_history()
+        """
+        self.driver.start_sonar_sampler(rate=rate, history=history)
+
+    def stop_sonar_sampler(self):
+        """Stop the background pinging started by start_sonar_sampler()"""
+        self.driver.stop_sonar_sampler()
+
+    def sonar_history(self, side, n=None):
+        """Get the last n background readings from the "left" or "right" sonar
+        
+        Returns: list of (time in seconds, distance in cm), oldest first
+        """
+        return self.driver.sonar_history(side, n)
+
+    def set_sonar_filter(self, make_filter):
+        """Smooth out noisy sonar readings
+        
+        After this, left_sonar() and right_sonar() return filtered distances.
+        Each sonar gets its own filter, and the filters are told how far the
+        robot drove, so they don't lag behind when it moves. Turning makes
+        them start over.
+        
+        Parameters:
+        * make_filter: function that makes a new filter (from sonar.py), or
+          None to go back to raw readings
+        
+        Example:
+            from sonar import MedianFilter, KalmanFilter, FilterChain
+            robot.set_sonar_filter(lambda: FilterChain(MedianFilter(3), KalmanFilter()))
+        """
+        self._settle_command()
+        self.command = None
+        self.filtered = {'left': None, 'right': None}
+        self.sample_count = {'left': 0, 'right': 0}
+        if make_filter is None:
+            self.sonar_filters = None
+        else:
+            self.sonar_filters = {'left': make_filter(), 'right': make_filter()}
+
+    def _filter_sonar(self, side, distance):
+        """Run a raw sonar reading (or the new background readings) through the side's filter"""
+        if self.sonar_filters is None:
+            return distance
+        self._settle_command()
+        sonar_filter = self.sonar_filters[side]
+
+        if self.driver.sampler is None:
+            self.filtered[side] = sonar_filter.update(distance)
+            return self.filtered[side]
+
+        # Only feed the background readings the filter hasn't seen yet
+        new_readings, self.sample_count[side] = self.driver.sampler.since(side, self.sample_count[side])
+        for timestamp, reading in new_readings:
+            self.filtered[side] = sonar_filter.update(reading)
+        return distance if self.filtered[side] is None else self.filtered[side]
+
+    def _predict_motion(self, left, right, seconds):
+        """Tell the odometry and the sonar filters how the robot moved while the wheels ran"""
+        if not seconds > 0 or (left == 0 and right == 0):
+            return
+        if math.isfinite(seconds):
+            self.odometry.predict(left, right, seconds)
+        if self.sonar_filters is None:
+            return
+        if left == right and math.isfinite(seconds):
+            # The sonars face forward, so driving forward brings things closer
+            change = -left * self.cm_per_second * seconds
+        else:
+            change = None  # Turning points the sonars at something else
+        for sonar_filter in self.sonar_filters.values():
+            sonar_filter.predict(change)
+
+    def _settle_command(self):
+        """Tell the odometry and sonar filters about the part of a start_motors() command that has run so far"""
+        command = self.command
+        if command is None:
+            return
+        # The simulator can run faster than real time
+        time_scale = getattr(self.driver, 'time_scale', 1)
+        elapsed = (time.perf_counter() - command['start']) * time_scale
+        elapsed = min(elapsed, command['seconds']) if math.isfinite(elapsed) else command['seconds']
+        self._predict_motion(command['left'], command['right'], elapsed - command['predicted'])
+        command['predicted'] = elapsed
+        if elapsed >= command['seconds'] or not self.driver.is_moving():
+            self.command = None
+
+    def start_recording(self, path, seed=None):
+        """Write every motors command and sonar reading to a file, to replay later
+        
+        Python's and NumPy's random numbers are seeded (and the seed is
+        saved), so random.randint() gives the same numbers when the
+        recording is replayed. See ReplayDriver in recording.py.
+        
+        Parameters:
+        * path: file to write (JSON lines, e.g. "run.jsonl")
+        * seed: random seed (picked at random if None)
+        
+        Example:
+            robot.start_recording("run.jsonl")
+            ...
+            # later, on any computer:
+            from recording import ReplayDriver
+            print(ReplayDriver("run.jsonl").run())
+        """
+        self.stop_recording()
+        if seed is None:
+            seed = random.randrange(2**32)
+        seed_random(seed)
+        self.recorder = Recorder(
+            path, seed,
+            n_obstacles=getattr(self.driver, 'n_obstacles', None),
+            randomize_obstacles=getattr(self.driver, 'randomize_obstacles', None),
+            time_scale=getattr(self.driver, 'time_scale', 1),
+            pose=self._pose(),
+        )
+
+    def stop_recording(self):
+        """Finish the file started by start_recording()"""
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def _end_command(self):
+        """Stop a start_motors() command that is still running, before recording what ends it
+
+        Returns: fields for that event. The simulator says how long the
+        command ran in simulated seconds ("ran"), so a replay can run it for
+        exactly as long instead of guessing from the wall time between events.
+        """
+        if self.recorder is None or self.command is None:
+            return {}
+        ran = self.driver.stop()
+        return {} if ran is None else {'ran': ran}
+
+    def _record(self, event, **fields):
+        if self.recorder is not None:
+            self.recorder.write(event, **fields)
+
+    def _record_pose(self):
+        # Only the simulator knows where the robot is
+        if self.recorder is not None and self._pose() is not None:
+            x, y, heading = self._pose()
+            self.recorder.write('pose', x=x, y=y, heading=heading)
+
+    def _pose(self):
+        if not hasattr(self.driver, 'heading'):
+            return None
+        return (float(self.driver.x), float(self.driver.y), float(self.driver.heading))
+
     def exit(self):
         """Stop the simulator and close the window"""
+        self.stop_recording()
         self.driver.exit()
 
 class Point:
@@ -187,6 +643,84 @@ class Box:
         corners = self.corners()
         return corners['front_right'], corners['front_left']
 
+class RobotGeometry:
+    """Corners and sonar positions of the robot, updated in place
+
+    The robot's size never changes, so its half diagonal and base angle are
+    worked out once. update() then recomputes the corners for a new pose
+    without creating any Point, Vector or Box objects, which makes it cheap
+    enough to call every frame. The corners match Box.corners() and are
+    stored in corner_x/corner_y in the order front_right, front_left,
+    back_left, back_right.
+    """
+    __slots__ = ("half_diagonal", "base_angle", "sonar_inset", "corner_x", "corner_y")
+
+    def __init__(self, width, height, sonar_inset):
+        self.half_diagonal = math.sqrt(width**2 + height**2) / 2
+        self.base_angle = math.degrees(math.atan2(height, width))
+        self.sonar_inset = sonar_inset
+        self.corner_x = [0.0] * 4
+        self.corner_y = [0.0] * 4
+
+    def update(self, x, y, heading):
+        """Move the corners to the robot pose (x, y, heading)"""
+        half_diagonal = self.half_diagonal
+        base_angle = self.base_angle
+        corner_x = self.corner_x
+        corner_y = self.corner_y
+
+        theta = math.radians(heading + 360 - base_angle)
+        corner_x[0] = x + round(half_diagonal * math.cos(theta))
+        corner_y[0] = y + round(half_diagonal * math.sin(theta))
+        theta = math.radians(heading + base_angle)
+        corner_x[1] = x + round(half_diagonal * math.cos(theta))
+        corner_y[1] = y + round(half_diagonal * math.sin(theta))
+        theta = math.radians(heading + 180 - base_angle)
+        corner_x[2] = x + round(half_diagonal * math.cos(theta))
+        corner_y[2] = y + round(half_diagonal * math.sin(theta))
+        theta = math.radians(heading + 180 + base_angle)
+        corner_x[3] = x + round(half_diagonal * math.cos(theta))
+        corner_y[3] = y + round(half_diagonal * math.sin(theta))
+
+    def sonar_positions(self):
+        """Get the left and right sonar positions for the last update()
+
+        Returns: (left_x, left_y, right_x, right_y)
+        """
+        front_right_x, front_left_x = self.corner_x[0], self.corner_x[1]
+        front_right_y, front_left_y = self.corner_y[0], self.corner_y[1]
+
+        # The sonars sit sonar_inset in from each front corner, along the front edge
+        edge_theta = math.degrees(math.atan2(front_right_y - front_left_y, front_right_x - front_left_x))
+        inset = self.sonar_inset
+        theta = math.radians(edge_theta)
+        left_x = front_left_x + round(inset * math.cos(theta))
+        left_y = front_left_y + round(inset * math.sin(theta))
+        theta = math.radians(edge_theta + 180)
+        right_x = front_right_x + round(inset * math.cos(theta))
+        right_y = front_right_y + round(inset * math.sin(theta))
+        return left_x, left_y, right_x, right_y
+
+    def corner_points(self):
+        """Get the corners as a list of (x, y) tuples"""
+        return list(zip(self.corner_x, self.corner_y))
+
+def rectangles_overlap(corners_a, corners_b):
+    """Check if two rectangles overlap, using the Separating Axis Theorem
+
+    corners_a, corners_b: the four (x, y) corners of each rectangle, in order
+    around the rectangle. Rectangles that only touch don't overlap.
+    """
+    for corners in (corners_a, corners_b):
+        # A rectangle only has two edge directions, so two axes to test
+        for (x1, y1), (x2, y2) in ((corners[0], corners[1]), (corners[1], corners[2])):
+            axis_x, axis_y = y1 - y2, x2 - x1
+            a = [x * axis_x + y * axis_y for x, y in corners_a]
+            b = [x * axis_x + y * axis_y for x, y in corners_b]
+            if max(a) <= min(b) or max(b) <= min(a):
+                return False
+    return True
+
 class Obstacle:
     """Represents a rectangular obstacle in the arena"""
     
@@ -196,23 +730,34 @@ class Obstacle:
         self.width = width
         self.height = height
         self.heading = heading
+
+        # Obstacles never move, so the corners and bounding box are worked out once
+        self._corners = self.box.corners()
+        self.corner_points = [(corner.x, corner.y) for corner in self._corners.values()]
+        xs = [x for x, y in self.corner_points]
+        ys = [y for x, y in self.corner_points]
+        self.bounds = (min(xs), min(ys), max(xs), max(ys))
     
     def corners(self):
         """Get the four corners of the obstacle"""
-        return self.box.corners()
+        return self._corners
     
     def contains_point(self, point):
         """Check if a point is inside this obstacle"""
-        # This needs to be updated for rotated boxes, but skip for now
+        # Rotate the point into the obstacle's frame, where it is axis-aligned
+        dx = point.x - self.center.x
+        dy = point.y - self.center.y
+        along = dx * cos(self.heading) + dy * sin(self.heading)
+        across = -dx * sin(self.heading) + dy * cos(self.heading)
         half_width = self.width / 2
         half_height = self.height / 2
         
-        return (abs(point.x - self.center.x) < half_width and 
-                abs(point.y - self.center.y) < half_height)
+        return abs(along) < half_width and abs(across) < half_height
 
 # Simulator Driver
 class SimulatorDriver:
-    def __init__(self, n_obstacles = 0, randomize_obstacles = False):
+    def __init__(self, n_obstacles = 0, randomize_obstacles = False, headless = False,
+                 physics_fps = 60, render_fps = 60, time_scale = 1):
         print("simulator initializing...")
         if n_obstacles is None:
             n_obstacles = 0
@@ -220,12 +765,32 @@ class SimulatorDriver:
             randomize_obstacles = False
         self.n_obstacles = n_obstacles
         self.randomize_obstacles = randomize_obstacles
+        # Headless mode skips all pygame setup and drawing, so physics runs
+        # as fast as the CPU allows instead of at self.fps frames per second
+        self.headless = headless
 
         # Physics constants
-        self.fps = 60
+        # degrees_per_frame and speed_per_power are measured per frame at
+        # calibration_fps, and are scaled when physics runs at another fps
+        self.fps = physics_fps
+        self.calibration_fps = 60
         self.degrees_per_frame = 0.98
         self.speed_per_power = 1
 
+        # Drawing runs independently of physics: the screen is redrawn every
+        # fps / render_fps physics frames, and time_scale speeds up (or slows
+        # down) the whole simulation compared to real time (inf = no limit)
+        self.render_fps = render_fps
+        self.time_scale = time_scale
+
+        # Command from start_motors() that is still running, see _catch_up()
+        self.command = None
+
+        # Per-stage frame timings, see start_profiling(). None (the default)
+        # skips all timing.
+        self.profiler = None
+        self.profile_overlay = None  # (time drawn, lines of text)
+
         # Robot dimensions (real world in mm)
         # actual robot pegboard is 20cm x 20cm with the wheels sticking out
         # another 1cm on each side
@@ -233,6 +798,15 @@ class SimulatorDriver:
         self.robot_width = self.robot_size
         self.robot_height = self.robot_size
         self.sonar_inset = 30  # 3cm from corners
+        self.geometry = RobotGeometry(self.robot_width, self.robot_height, self.sonar_inset)
+
+        # Background pinging, see start_sonar_sampler(). The sampler thread
+        # has its own RobotGeometry so it never touches the one physics uses.
+        # The lock keeps it from reading a pose that is half written (see
+        # _current_pose()).
+        self.sampler = None
+        self.sampler_geometry = RobotGeometry(self.robot_width, self.robot_height, self.sonar_inset)
+        self.motor_lock = threading.RLock()
         
         # Arena dimensions (real world in mm)
         self.box_width = 2000   # 2m = 2000mm
@@ -282,8 +856,13 @@ class SimulatorDriver:
         self.obstacles = []
         if self.n_obstacles > 0:
             self._generate_obstacles()
+        self._index_obstacles()
 
         # Graphics
+        self.background = None
+        if self.headless:
+            return
+        _import_pygame()
         self.clock = pygame.time.Clock()
         self._load_images()
         self.start_simulation()
@@ -307,32 +886,53 @@ class SimulatorDriver:
             self.obstacles.append(obstacle)
             print(f"Obstacle {i+1} ({spec['name']}): {width}x{height}mm at ({x}, {y}), rotated {heading}°")
 
-    def _draw_obstacles(self):
-        """Draw obstacles on the screen"""
+    def set_obstacles(self, obstacles):
+        """Replace the obstacles in the arena with a list of Obstacle objects"""
+        self.obstacles = list(obstacles)
+        self.n_obstacles = len(self.obstacles)
+        self._index_obstacles()
+        # The background has the old obstacles drawn on it
+        self.background = None
+
+    def _index_obstacles(self):
+        """Build the bounding boxes and spatial index used for crashes and sonars"""
+        self.obstacle_bounds = np.array([obstacle.bounds for obstacle in self.obstacles]).reshape(-1, 4)
+
+        segments = []
+        for obstacle in self.obstacles:
+            corners = list(obstacle.corners().values())
+            for start, end in zip(corners, corners[1:] + corners[:1]):
+                segments.append((start.x, start.y, end.x, end.y))
+        self.obstacle_index = SegmentGrid(
+            segments, (self.min_x_box, self.min_y_box, self.max_x_box, self.max_y_box)
+        )
+
+    def _draw_obstacles(self, surface):
+        """Draw obstacles on a surface the size of the screen"""
         for i, obstacle in enumerate(self.obstacles):
             # Get obstacle corners
             corners = obstacle.corners()
             
             # Convert corners to screen coordinates
             corner_points = [
-                corners['front_right'].to_screen(self.screen),
-                corners['front_left'].to_screen(self.screen),
-                corners['back_left'].to_screen(self.screen),
-                corners['back_right'].to_screen(self.screen)
+                corners['front_right'].to_screen(surface),
+                corners['front_left'].to_screen(surface),
+                corners['back_left'].to_screen(surface),
+                corners['back_right'].to_screen(surface)
             ]
             
             # Draw filled rectangle
-            pygame.draw.polygon(self.screen, (150, 75, 0), corner_points)  # Brown color
+            pygame.draw.polygon(surface, (150, 75, 0), corner_points)  # Brown color
             
             # Draw border
-            pygame.draw.polygon(self.screen, (0, 0, 0), corner_points, 2)  # Black border
+            pygame.draw.polygon(surface, (0, 0, 0), corner_points, 2)  # Black border
             
             # Draw obstacle number (optional, for debugging)
             if debug:
-                center_screen = obstacle.center.to_screen(self.screen)
+                center_screen = obstacle.center.to_screen(surface)
                 font = self.debug_font
                 label = font.render(f"{i+1}", True, (255, 255, 255))
-                self.screen.blit(label, (center_screen[0] - 5, center_screen[1] - 5))
+                surface.blit(label, (center_screen[0] - 5, center_screen[1] - 5))
 
     def _calculate_box_boundaries(self):
         self.max_x_box = self.box_width / 2 + self.origin.x
@@ -417,85 +1017,463 @@ class SimulatorDriver:
         )
         self.img = self.img_left
 
+        # Rotated copies of the images, see _rotated_robot_image
+        self.sprite_cache = OrderedDict()
+        self.sprite_cache_step = 0.25  # degrees
+        self.sprite_cache_size = 256
+
      
     def _detect_crash(self):
-        """Check if robot has collided with arena boundaries"""
-        robot_box = self._get_robot_box()
-        corners = robot_box.corners()
+        """Check if robot has collided with arena boundaries or an obstacle"""
+        return self._crash_at(self.x, self.y, self.heading)
+
+    def _crash_at(self, x, y, heading):
+        """Check if the robot would collide with the arena boundaries or an obstacle at a given pose"""
+        geometry = self.geometry
+        geometry.update(x, y, heading)
 
         # Check if any robot corner is outside arena bounds
-        for corner in corners.values():
-            xcrash = corner.x > self.max_x_box or corner.x < self.min_x_box
-            ycrash = corner.y > self.max_y_box or corner.y < self.min_y_box
-            if xcrash or ycrash:
+        for corner_x in geometry.corner_x:
+            if corner_x > self.max_x_box or corner_x < self.min_x_box:
+                return True
+        for corner_y in geometry.corner_y:
+            if corner_y > self.max_y_box or corner_y < self.min_y_box:
                 return True
-        return False
+
+        if not self.obstacles:
+            return False
+        corner_points = geometry.corner_points()
+        return any(
+            rectangles_overlap(corner_points, self.obstacles[i].corner_points)
+            for i in self._obstacles_near(corner_points)
+        )
+
+    def _obstacles_near(self, corner_points, dx=0, dy=0, num_frames=0):
+        """Indexes of obstacles whose bounding box overlaps the robot's
+
+        With dx, dy and num_frames, the robot's box is stretched to cover
+        everywhere it goes while driving num_frames frames of (dx, dy).
+        """
+        xs = [x for x, y in corner_points]
+        ys = [y for x, y in corner_points]
+        min_x, max_x = min(xs) + min(0, dx * num_frames), max(xs) + max(0, dx * num_frames)
+        min_y, max_y = min(ys) + min(0, dy * num_frames), max(ys) + max(0, dy * num_frames)
+
+        bounds = self.obstacle_bounds
+        near = (bounds[:, 0] < max_x) & (bounds[:, 2] > min_x) & (bounds[:, 1] < max_y) & (bounds[:, 3] > min_y)
+        return np.nonzero(near)[0]
+
+    def _clearance(self, x, y):
+        """Distance from (x, y) to the nearest wall or obstacle bounding box"""
+        clearance = min(self.max_x_box - x, x - self.min_x_box,
+                        self.max_y_box - y, y - self.min_y_box)
+        if self.obstacles:
+            bounds = self.obstacle_bounds
+            gap_x = np.maximum(np.maximum(bounds[:, 0] - x, x - bounds[:, 2]), 0)
+            gap_y = np.maximum(np.maximum(bounds[:, 1] - y, y - bounds[:, 3]), 0)
+            clearance = min(clearance, np.sqrt(gap_x**2 + gap_y**2).min())
+        return clearance
+
+    def _crash(self):
+        """Handle a crash at the current pose"""
+        if debug:
+            print("Crash!!!! Restarting!")
+            with self.motor_lock:
+                self.x = 0
+                self.y = 0
+                self.heading = 0
+        else:
+            print((self.x,self.y))
+            raise Exception(
+                "Ooops! Dr. Ebee doesn't know how to simulate what happens when you "
+                "hit the walls or an obstacle. Also, it's not good for the robot anyway. Try again!!"
+            )
 
     def motors(self, left, right, seconds):
         """Apply power to motors for a duration"""
-        num_frames = round(seconds * self.fps)
-        
-        for _ in range(num_frames):
-            self._update_position(left, right)
-            if self._detect_crash():
-                if debug:
-                    print("Crash!!!! Restarting!")
-                    self.x = 0
-                    self.y = 0
-                    self.heading = 0
-                else:
-                    print((self.x,self.y))
-                    raise Exception(
-                        "Ooops! Dr. Ebee doesn't know how to simulate what happens when you "
-                        "hit the walls. Also, it's not good for the robot anyway. Try again!!"
-                    )
+        self.stop()
+        self._run_frames(left, right, round(seconds * self.fps))
+
+    def run_trajectory(self, segments, on_progress=None):
+        """Run (left, right, seconds) segments back to back
+
+        Each segment ends on the frame closest to the total time so far, so
+        rounding to whole frames doesn't add up over a long trajectory.
+        """
+        self.stop()
+        for left, right, seconds in segments:
+            self._frame_deltas(left, right)  # Reject bad powers before moving at all
+
+        end_time = 0
+        frames_done = 0
+        for index, (left, right, seconds) in enumerate(segments):
+            end_time += seconds
+            num_frames = round(end_time * self.fps) - frames_done
+            self._run_frames(left, right, num_frames)
+            frames_done += num_frames
+            if on_progress is not None:
+                on_progress(index + 1, len(segments))
+        return frames_done / self.fps
+
+    def _run_frames(self, left, right, num_frames):
+        """Move for num_frames frames, drawing and keeping time unless headless"""
+        if self.headless:
+            # Nothing is drawn, so jump straight to the end pose
+            self._advance(left, right, num_frames)
+            return
+
+        frames_per_render = max(1, round(self.fps / self.render_fps))
+        renders_per_second = self.fps * self.time_scale / frames_per_render
+        if np.isinf(renders_per_second):
+            renders_per_second = 0  # clock.tick(0) doesn't wait
+        while num_frames > 0:
+            frames = min(frames_per_render, num_frames)
+            self._advance(left, right, frames)
+            num_frames -= frames
             
             self.render()
+            if self.profiler is not None:
+                self.profiler.mark()
+            self.clock.tick(renders_per_second)
+            if self.profiler is not None:
+                self.profiler.lap("tick")
+
+    def start_motors(self, left, right, seconds=None):
+        """Start applying power to the motors without waiting
+
+        The robot isn't moved here. Instead, _catch_up() runs however many
+        frames are due for the wall time since the command started (times
+        time_scale) whenever the robot's state is read. Nothing runs in the
+        background, so the script has to keep polling (is_moving(), the
+        sonars or update()) for the window to redraw and stay responsive.
+        """
+        self.stop()
+        self._frame_deltas(left, right)  # Reject bad powers now, not on the next read
+        self.command = {
+            'left': left,
+            'right': right,
+            'start': time.perf_counter(),
+            'frames_done': 0,
+            'frames_total': None if seconds is None else round(seconds * self.fps),
+        }
+
+    def stop(self):
+        """Finish moving for a running start_motors() command and stop
+
+        Returns: how many simulated seconds the command ran for, or None if
+        there wasn't one still running
+        """
+        self._catch_up()
+        command = self.command
+        self.command = None
+        if command is not None:
+            return command['frames_done'] / self.fps
+
+    def is_moving(self):
+        """Check if a start_motors() command is still running"""
+        self._catch_up()
+        return self.command is not None
+
+    def update(self):
+        """Bring the robot up to date with a running start_motors() command"""
+        self._catch_up()
+
+    def _catch_up(self):
+        """Run the frames of the current start_motors() command that are due by now"""
+        command = self.command
+        if command is None:
+            return
+
+        frames_total = command['frames_total']
+        frames_due = self._frames_due(command)
+        frames = frames_due - command['frames_done']
+        if frames > 0:
+            # Under the lock, so the sampler sees frames_done and the pose change together
+            with self.motor_lock:
+                command['frames_done'] = frames_due
+                if frames_due == frames_total:
+                    self.command = None
+                try:
+                    self._advance(command['left'], command['right'], frames)
+                except Exception:
+                    self.command = None
+                    raise
+            if not self.headless:
+                self.render()
+        elif frames_due == frames_total:
+            self.command = None
+
+    def _frames_due(self, command):
+        """How many frames of a start_motors() command should have run by now"""
+        frames_total = command['frames_total']
+        elapsed = (time.perf_counter() - command['start']) * self.time_scale
+        if np.isinf(elapsed):
+            return frames_total if frames_total is not None else command['frames_done']
+        frames_due = round(elapsed * self.fps)
+        if frames_total is not None:
+            frames_due = min(frames_due, frames_total)
+        return frames_due
+
+    def _current_pose(self):
+        """(x, y, heading) the robot has by now, without moving it
+
+        Safe to call from the sampler thread: the pose is copied under
+        motor_lock, and the frames of a running start_motors() command that
+        haven't been run yet are added on with _pose_after (ignoring
+        crashes, which the main thread finds when it catches up).
+        """
+        with self.motor_lock:
+            pose = self.x, self.y, self.heading
+            command = self.command
+            if command is None:
+                return pose
+            frames_done = command['frames_done']
+        frames = self._frames_due(command) - frames_done
+        if frames <= 0:
+            return pose
+        turn, forward = self._frame_deltas(command['left'], command['right'])
+        return self._pose_after(turn, forward, frames, pose)
 
     def _update_position(self, left, right):
         """Update robot position based on motor powers"""
-        if left == right:
-            if left != 0:
-                # Move forward or backward
-                speed = left * self.speed_per_power
-                self.x += speed * cos(self.heading)
-                self.y += speed * sin(self.heading)
-        elif left == -right:
-            if right == 1:
-                # Rotate clockwise
-                self.heading = (self.heading - self.degrees_per_frame) % 360
+        turn, forward = self._frame_deltas(left, right)
+        with self.motor_lock:
+            if turn != 0:
+                self.heading = (self.heading + turn) % 360
+            if forward != 0:
+                self.x += forward * cos(self.heading)
+                self.y += forward * sin(self.heading)
+
+    def _frame_deltas(self, left, right):
+        """Get how much one frame of the given motor powers moves the robot
+
+        Returns: (turn, forward). Each frame the heading changes by `turn`
+        degrees first, then the robot moves `forward` mm along the new heading.
+        """
+        turn, forward = self._calibrated_frame_deltas(left, right)
+        scale = self.calibration_fps / self.fps
+        return turn * scale, forward * scale
+
+    def _calibrated_frame_deltas(self, left, right):
+        """(turn, forward) for one frame at calibration_fps, see _frame_deltas
+
+        Powers can be anything from -1 (full BACKWARD) to 1 (full FORWARD),
+        and are turned into motion by motion_plan.drive_model: the old table
+        for FORWARD, BACKWARD and STOP, and differential drive for anything
+        in between.
+        """
+        for power in (left, right):
+            if not -1 <= power <= 1:
+                raise Exception(
+                    "Ooops! Dr. Ebee's motors only go from BACKWARD (-1) to FORWARD (1). "
+                    "Use a number in between (like 0.5 for half power) as "
+                    "input to the `motors` function!!"
+                )
+
+        turn, forward = drive_model(left, right)
+        return turn * self.degrees_per_frame, forward * self.speed_per_power
+
+    def _pose_after(self, turn, forward, num_frames, pose=None):
+        """Get the pose after num_frames frames of _update_position, in O(1)
+
+        Every frame turns by the same amount, so the headings form an
+        arithmetic series and the sum of their cosines/sines has a closed form.
+        The result matches frame-by-frame stepping to floating point rounding
+        (well under 1e-6 mm and 1e-9 degrees for commands of any length).
+        Starts from pose (x, y, heading) if given, otherwise the robot's pose.
+        """
+        x, y, heading = (self.x, self.y, self.heading) if pose is None else pose
+        if turn == 0:
+            if forward != 0:
+                x += num_frames * forward * cos(heading)
+                y += num_frames * forward * sin(heading)
+            return x, y, heading
+
+        if forward != 0:
+            # sum(cos(heading + k * turn) for k in 1..num_frames)
+            scale = forward * sin(num_frames * turn / 2) / sin(turn / 2)
+            mid_heading = heading + (num_frames + 1) * turn / 2
+            x += scale * cos(mid_heading)
+            y += scale * sin(mid_heading)
+        return x, y, (heading + num_frames * turn) % 360
+
+    # How close (mm) the robot can come to a wall or obstacle before rounding
+    # decides whether it crashed, see _first_crash_frame_straight
+    TOUCH = 1e-6
+
+    def _first_crash_frame(self, turn, forward, num_frames):
+        """Find the first of the next num_frames frames that crashes, or None"""
+        if turn == 0:
+            return self._first_crash_frame_straight(forward, num_frames)
+
+        # While turning the corners stay within this radius of the center
+        # (plus rounding of the corner offsets), and the center moves at most
+        # |forward| mm per frame, so any frame closer than clearance / |forward|
+        # cannot crash and is skipped without being checked
+        radius = np.sqrt(self.robot_width**2 + self.robot_height**2) / 2 + 1
+        if forward == 0:
+            # Spinning in place repeats itself after a full turn
+            num_frames = min(num_frames, int(360 / abs(turn)) + 2)
+
+        frame = 1
+        while frame <= num_frames:
+            x, y, heading = self._pose_after(turn, forward, frame)
+            clearance = self._clearance(x, y) - radius
+            if clearance > 0:
+                if forward == 0:
+                    return None
+                frame += max(1, int(np.ceil(clearance / abs(forward))))
+            elif self._crash_at(x, y, heading):
+                return frame
             else:
-                # Rotate counter-clockwise
-                self.heading = (self.heading + self.degrees_per_frame) % 360
-
-        elif (left == 0 or right == 0) and (abs(left) == 1 or abs(right) == 1):
-            # One wheel stopped, pivot around it
-            # Pivoting is half the speed of spinning in place
-            pivot_degrees_per_frame = self.degrees_per_frame / 2
-            pivot_forward_per_frame = 0.208  # 75mm in 6 seconds = 12.5mm/sec = 0.208mm/frame
-            
-            if left == 0 and right != 0:
-                # Pivot around left wheel
-                direction = -1 if right == 1 else 1  # clockwise if right forward
-                self.heading = (self.heading - direction * pivot_degrees_per_frame) % 360
-                # Move forward in current heading direction
-                self.x += right * pivot_forward_per_frame * cos(self.heading)
-                self.y += right * pivot_forward_per_frame * sin(self.heading)
-                
-            elif right == 0 and left != 0:
-                # Pivot around right wheel
-                direction = 1 if left == 1 else -1  # counter-clockwise if left forward
-                self.heading = (self.heading + direction * pivot_degrees_per_frame) % 360
-                # Move forward in current heading direction
-                self.x += left * pivot_forward_per_frame * cos(self.heading)
-                self.y += left * pivot_forward_per_frame * sin(self.heading)
-                
-        else:
-            raise Exception(
-                "Ooops! Dr. Ebee didn't write code that let's you use those numbers as "
-                "input to the `motors` function. If you *really* want those numbers, "
-                "schedule some time on her calendar to help her implement that change!!"
-            )
+                frame += 1
+        return None
+
+    def _first_crash_frame_straight(self, forward, num_frames):
+        """First crashing frame when driving in a straight line, or None
+
+        The corners keep the same offsets from the center, so each corner
+        crosses each wall, and the robot starts overlapping each obstacle,
+        at a frame that can be solved for directly. The estimate is then
+        checked against _crash_at to get the exact frame. Frames where the
+        robot only just touches a wall or an obstacle (within TOUCH mm, where
+        rounding decides) are checked against _crash_at one by one, so a
+        graze part-way along is found just like stepping frame by frame
+        would find it.
+        """
+        dx = forward * cos(self.heading)
+        dy = forward * sin(self.heading)
+        self.geometry.update(self.x, self.y, self.heading)
+        robot_points = self.geometry.corner_points()
+        first = num_frames + 1
+        grazes = []
+        if self.obstacles:
+            first, grazes = self._first_obstacle_frame_straight(robot_points, dx, dy, num_frames)
+        for corner_x, corner_y in robot_points:
+            for position, step, low, high in ((corner_x, dx, self.min_x_box, self.max_x_box),
+                                              (corner_y, dy, self.min_y_box, self.max_y_box)):
+                # Frames where the corner is within TOUCH of a wall
+                for wall in (low, high):
+                    if step == 0:
+                        if abs(position - wall) <= self.TOUCH:
+                            grazes.extend(self._frames_between(-np.inf, np.inf, num_frames))
+                    else:
+                        grazes.extend(self._frames_between(*sorted(((wall - self.TOUCH - position) / step,
+                                                                    (wall + self.TOUCH - position) / step)),
+                                                           num_frames))
+                if step == 0:
+                    if position < low or position > high:
+                        first = 1
+                    continue
+                # Frames between these two stay inside, position + k * step
+                enter, leave = sorted(((low - position) / step, (high - position) / step))
+                if enter >= 1:
+                    first = 1
+                elif leave < num_frames:
+                    first = min(first, max(1, int(np.floor(leave)) + 1))
+
+        for frame in sorted(set(grazes)):
+            if frame >= first:
+                break
+            if self._crash_at(*self._pose_after(0, forward, frame)):
+                return frame
+
+        if first > num_frames and not self._crash_at(*self._pose_after(0, forward, num_frames)):
+            return None
+        first = min(first, num_frames)
+        while first > 1 and self._crash_at(*self._pose_after(0, forward, first - 1)):
+            first -= 1
+        while first <= num_frames and not self._crash_at(*self._pose_after(0, forward, first)):
+            first += 1
+        return first if first <= num_frames else None
+
+    @staticmethod
+    def _frames_between(low, high, num_frames):
+        """Whole frames from 1 to num_frames that are between low and high (both included)"""
+        if not (low <= high and low <= num_frames and high >= 1):
+            return range(0)
+        low = 1 if low < 1 else int(np.ceil(low))
+        high = num_frames if high > num_frames else int(np.floor(high))
+        return range(low, high + 1)
+
+    def _first_obstacle_frame_straight(self, robot_points, dx, dy, num_frames):
+        """First frame (estimate) at which the robot overlaps an obstacle while
+        driving num_frames frames of (dx, dy), or num_frames + 1 if none
+
+        Swept Separating Axis Theorem: along each axis the robot's projection
+        slides at a constant rate, so the frames where it overlaps the
+        obstacle's projection form an interval. The robot overlaps the
+        obstacle on the frames that are inside every axis's interval.
+
+        Returns: (first frame, frames before it where the robot is within
+        TOUCH of overlapping, which the caller checks with _crash_at)
+        """
+        first = num_frames + 1
+        grazes = []
+        for i in self._obstacles_near(robot_points, dx, dy, num_frames):
+            obstacle_points = self.obstacles[i].corner_points
+            enter, leave = -np.inf, np.inf  # frames that overlap
+            near_enter, near_leave = -np.inf, np.inf  # frames that overlap or nearly do
+            for points in (robot_points, obstacle_points):
+                for (x1, y1), (x2, y2) in ((points[0], points[1]), (points[1], points[2])):
+                    axis_x, axis_y = y1 - y2, x2 - x1
+                    a = [x * axis_x + y * axis_y for x, y in robot_points]
+                    b = [x * axis_x + y * axis_y for x, y in obstacle_points]
+                    touch = self.TOUCH * math.hypot(axis_x, axis_y)
+                    speed = dx * axis_x + dy * axis_y
+                    if speed == 0:
+                        if max(a) <= min(b) - touch or max(b) <= min(a) - touch:
+                            near_enter, near_leave = np.inf, -np.inf
+                        if max(a) <= min(b) or max(b) <= min(a):
+                            enter, leave = np.inf, -np.inf
+                        continue
+                    # Overlapping while min(a) + k * speed < max(b) and max(a) + k * speed > min(b)
+                    low, high = sorted(((min(b) - max(a)) / speed, (max(b) - min(a)) / speed))
+                    enter, leave = max(enter, low), min(leave, high)
+                    low, high = sorted(((min(b) - max(a) - touch) / speed, (max(b) - min(a) + touch) / speed))
+                    near_enter, near_leave = max(near_enter, low), min(near_leave, high)
+            if not near_enter < near_leave:
+                continue
+            if enter < leave and enter < num_frames:
+                frame = 1 if enter < 1 else int(np.floor(enter)) + 1
+            else:
+                frame = np.inf
+            if frame < leave:
+                first = min(first, frame)
+                near_leave = min(near_leave, frame - 1)
+            grazes.extend(self._frames_between(near_enter, near_leave, num_frames))
+        return first, grazes
+
+    def _advance(self, left, right, num_frames):
+        """Run num_frames frames of motor power without drawing them
+
+        Same result as calling _update_position and _detect_crash once per
+        frame, but the cost doesn't depend on how many frames are run.
+        """
+        if num_frames <= 0:
+            return
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.mark()
+        turn, forward = self._frame_deltas(left, right)
+        while num_frames > 0:
+            crash_frame = self._first_crash_frame(turn, forward, num_frames)
+            if profiler is not None:
+                profiler.lap("crash")
+            if crash_frame is None:
+                pose = self._pose_after(turn, forward, num_frames)
+                with self.motor_lock:
+                    self.x, self.y, self.heading = pose
+                if profiler is not None:
+                    profiler.lap("position")
+                return
+            pose = self._pose_after(turn, forward, crash_frame)
+            with self.motor_lock:
+                self.x, self.y, self.heading = pose
+            if profiler is not None:
+                profiler.lap("position")
+            self._crash()
+            num_frames -= crash_frame
     
     def dist_to_box(self, sonar_position, h):
         """Calculate distance from sonar position to nearest wall in direction h"""
@@ -528,41 +1506,79 @@ class SimulatorDriver:
         
         return min(dist_to_horizontal, dist_to_vertical)
     
+    def dist_to_obstacle(self, sonar_position, h):
+        """Calculate distance from sonar position to the nearest obstacle edge in direction h"""
+        return self.obstacle_index.cast(sonar_position.x, sonar_position.y, h)
+
+    def sonar_distance(self, sonar_position, h):
+        """Calculate distance from sonar position to the nearest wall or obstacle in direction h"""
+        return min(self.dist_to_box(sonar_position, h), self.dist_to_obstacle(sonar_position, h))
+
     def left_sonar(self):
+        self._catch_up()
+        distance = None if self.sampler is None else self.sampler.read('left')
+        if distance is not None:
+            return distance
         left_sonar_position, right_sonar_position = self._get_sonar_positions()
         
-        left_dist = self.dist_to_box(left_sonar_position, self.heading) / 10
+        left_dist = self.sonar_distance(left_sonar_position, self.heading) / 10
         return left_dist
 
     def right_sonar(self):
+        self._catch_up()
+        distance = None if self.sampler is None else self.sampler.read('right')
+        if distance is not None:
+            return distance
         left_sonar_position, right_sonar_position = self._get_sonar_positions()
-        right_dist = self.dist_to_box(right_sonar_position, self.heading) / 10
+        right_dist = self.sonar_distance(right_sonar_position, self.heading) / 10
         
         return right_dist
 
     def sonars(self):
-        """Get distances from left and right sonar sensors to nearest walls"""
+        """Get distances from left and right sonar sensors to nearest walls or obstacles"""
+        self._catch_up()
+        if self.sampler is not None:
+            return self.left_sonar(), self.right_sonar()
         left_sonar_position, right_sonar_position = self._get_sonar_positions()
         
-        left_dist = self.dist_to_box(left_sonar_position, self.heading) / 10
-        right_dist = self.dist_to_box(right_sonar_position, self.heading) / 10
+        left_dist = self.sonar_distance(left_sonar_position, self.heading) / 10
+        right_dist = self.sonar_distance(right_sonar_position, self.heading) / 10
         
         return left_dist, right_dist
     
+    def start_sonar_sampler(self, rate=20, history=100):
+        """Ping the sonars in turn on a background thread, like the real robot"""
+        self.stop_sonar_sampler()
+        self.sampler = SonarSampler(
+            lambda: self._sample_sonar('left'), lambda: self._sample_sonar('right'),
+            rate=rate, history=history
+        )
+        self.sampler.start()
+
+    def stop_sonar_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def sonar_history(self, side, n=None):
+        if self.sampler is None:
+            return []
+        return self.sampler.history(side, n)
+
+    def _sample_sonar(self, side):
+        """Read one sonar from the sampler thread, at the robot's current pose"""
+        x, y, heading = self._current_pose()
+        self.sampler_geometry.update(x, y, heading)
+        left_x, left_y, right_x, right_y = self.sampler_geometry.sonar_positions()
+        if side == 'left':
+            return self.sonar_distance(Point(left_x, left_y), heading) / 10
+        return self.sonar_distance(Point(right_x, right_y), heading) / 10
+
     def _get_sonar_positions(self):
         """Calculate the world positions of left and right sonars"""
-        robot_box = self._get_robot_box()
-        front_right_corner, front_left_corner = robot_box.front_edge()
-        
-        front_edge = Vector.from_points(front_left_corner, front_right_corner)
-        
-        left_sonar_offset = Vector(self.sonar_inset, front_edge.theta)
-        left_sonar_position = front_left_corner + left_sonar_offset.to_point()
-        
-        right_sonar_offset = Vector(self.sonar_inset, front_edge.theta + 180)
-        right_sonar_position = front_right_corner + right_sonar_offset.to_point()
-        
-        return left_sonar_position, right_sonar_position
+        self.geometry.update(self.x, self.y, self.heading)
+        left_x, left_y, right_x, right_y = self.geometry.sonar_positions()
+        return Point(left_x, left_y), Point(right_x, right_y)
 
 
     def _draw_sonar_debug(self):
@@ -595,22 +1611,74 @@ class SimulatorDriver:
 
     def render(self):
         """Draw the current frame"""
-        self.screen.fill((255, 255, 255))
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.mark()
+        if self.background is None:
+            self.background = self._draw_background()
+        self.screen.blit(self.background, (0, 0))
+        if profiler is not None:
+            profiler.lap("background")
         
         self._draw_robot()
-        self._draw_arena_border()
-        self._draw_obstacles()
+        if profiler is not None:
+            profiler.lap("robot")
         self._draw_debug_info()
         self._draw_sonar_debug()
-        if(False):
-            for event in pygame.event.get():
-                if(event == pygame.QUIT):
-                    print("exiting")
-                    quit()
-                else:
-                    print(event)
+        if profiler is not None:
+            profiler.lap("debug")
+            self._draw_profile_overlay()
+            profiler.mark()  # the overlay's own drawing isn't counted
+        # Handle window events so the window keeps responding between commands
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.exit()
         pygame.display.flip()
-        self.clock.tick(self.fps)
+        if profiler is not None:
+            profiler.lap("flip")
+
+    def start_profiling(self, history=300):
+        """Time every stage of every frame, keeping the last `history` times of each
+
+        Stages: position and crash (physics), background (arena and
+        obstacles), robot, debug (the debug overlays), flip (window events
+        and showing the frame) and tick (waiting to keep real time). The
+        times are drawn in the corner of the window, and stats() returns them.
+        """
+        self.profiler = FrameProfiler(history)
+        self.profile_overlay = None
+
+    def stop_profiling(self):
+        self.profiler = None
+
+    def stats(self):
+        """p50, p95 and max milliseconds of each stage since start_profiling()
+
+        Returns: dict like {"robot": {"p50": 0.2, "p95": 0.4, "max": 1.3, "count": 300}, ...},
+        empty if profiling is off
+        """
+        if self.profiler is None:
+            return {}
+        return self.profiler.stats()
+
+    def _draw_profile_overlay(self):
+        """Draw each stage's frame times in the top left corner
+
+        The text is only redrawn twice a second, so the overlay doesn't slow
+        down the frames it is measuring.
+        """
+        now = time.perf_counter()
+        if self.profile_overlay is None or now - self.profile_overlay[0] > 0.5:
+            font = self.debug_font
+            lines = [font.render("stage: p50 / p95 / max ms", True, (0, 0, 0))]
+            for stage, times in self.profiler.stats().items():
+                line = f"{stage}: {times['p50']:.2f} / {times['p95']:.2f} / {times['max']:.2f}"
+                lines.append(font.render(line, True, (0, 0, 0)))
+            self.profile_overlay = (now, lines)
+
+        corner = self.padding + self.wall_thickness + 5
+        for i, text in enumerate(self.profile_overlay[1]):
+            self.screen.blit(text, (corner, corner + i * 14))
 
     def _draw_robot(self):
         """Draw the robot at its current position and heading"""
@@ -620,11 +1688,7 @@ class SimulatorDriver:
         if debug and frame % 100 == 0:
             print(f"heading: {self.heading}, cosine: {cos(self.heading)}")
         
-        # Choose image based on heading direction
-        if cos(self.heading) >= 0:
-            rotated_img = pygame.transform.rotate(self.img_right, self.heading + 90)
-        else:
-            rotated_img = pygame.transform.rotate(self.img_left, self.heading - 90)
+        rotated_img = self._rotated_robot_image(self.heading)
         
         # Draw robot at current position
         rect = rotated_img.get_rect()
@@ -632,24 +1696,60 @@ class SimulatorDriver:
         rect.center = position.to_screen(self.screen)
         self.screen.blit(rotated_img, rect)
 
-    def _draw_arena_border(self):
-        """Draw the arena boundary lines"""
+    def _rotated_robot_image(self, heading):
+        """Get the robot image rotated to a heading, from the sprite cache if possible
+
+        Headings are rounded to sprite_cache_step degrees, so the robot only
+        ever needs a few hundred different sprites. The least recently used
+        sprite is dropped once the cache holds sprite_cache_size of them.
+        """
+        step = self.sprite_cache_step
+        key = round(heading / step) % round(360 / step)
+        rotated_img = self.sprite_cache.get(key)
+        if rotated_img is not None:
+            self.sprite_cache.move_to_end(key)
+            return rotated_img
+
+        quantized_heading = key * step
+        # Choose image based on heading direction
+        if cos(quantized_heading) >= 0:
+            rotated_img = pygame.transform.rotate(self.img_right, quantized_heading + 90)
+        else:
+            rotated_img = pygame.transform.rotate(self.img_left, quantized_heading - 90)
+
+        self.sprite_cache[key] = rotated_img
+        if len(self.sprite_cache) > self.sprite_cache_size:
+            self.sprite_cache.popitem(last=False)
+        return rotated_img
+
+    def _draw_background(self):
+        """Draw everything that doesn't move (arena and obstacles) onto a new surface"""
+        background = pygame.Surface(self.screen.get_size())
+        background.fill((255, 255, 255))
+        self._draw_arena_border(background)
+        self._draw_obstacles(background)
+        return background.convert()
+
+    def _draw_arena_border(self, surface):
+        """Draw the arena boundary lines on a surface the size of the screen"""
         padding = self.padding
         border = self.wall_thickness
         
         # White outer border
-        pygame.draw.rect(self.screen, (255, 255, 255), 
-                        self.screen.get_rect(), padding + border)
+        pygame.draw.rect(surface, (255, 255, 255), 
+                        surface.get_rect(), padding + border)
         
         # Black inner border
-        inner_rect = self.screen.get_rect().inflate(-padding * 2, -padding * 2)
-        pygame.draw.rect(self.screen, (0, 0, 0), inner_rect, border)
+        inner_rect = surface.get_rect().inflate(-padding * 2, -padding * 2)
+        pygame.draw.rect(surface, (0, 0, 0), inner_rect, border)
 
     def exit(self):
         print("Exiting simulation")
         self.running = False
-        pygame.display.quit()
-        pygame.quit()
+        self.stop_sonar_sampler()
+        if not self.headless:
+            pygame.display.quit()
+            pygame.quit()
         sys.exit()
         
     def start_simulation(self):
@@ -661,6 +1761,198 @@ class SimulatorDriver:
         pygame.display.set_caption("Robot Simulator")
         self.render()
 
+
+# Batch Simulator
+class BatchSimulator:
+    """Simulates many robots at once using NumPy arrays (no drawing)
+
+    Each robot has its own x, y and heading, stored as arrays of length n.
+    The physics constants are copied from a headless SimulatorDriver, so one
+    robot in the batch moves exactly like the single-robot simulator (to
+    floating point rounding). Only the arena walls are simulated.
+
+    A robot that crashes stays where it crashed and ignores later commands,
+    and its entry in `crashed` becomes True, instead of raising an exception.
+
+    Example:
+        # 10,000 robots starting at random headings
+        batch = BatchSimulator(10000, heading=np.random.uniform(0, 360, 10000))
+        batch.motors(FORWARD, BACKWARD, seconds=np.linspace(1, 2, 10000))
+        left, right = batch.sonars()
+    """
+
+    def __init__(self, n, x=0, y=0, heading=0, driver=None):
+        if driver is None:
+            driver = SimulatorDriver(headless=True)
+        self.driver = driver
+        self.n = n
+        self.fps = driver.fps
+        self.x = np.broadcast_to(np.asarray(x, dtype=float), (n,)).copy()
+        self.y = np.broadcast_to(np.asarray(y, dtype=float), (n,)).copy()
+        self.heading = np.broadcast_to(np.asarray(heading, dtype=float), (n,)).copy()
+        self.crashed = np.zeros(n, dtype=bool)
+
+        # Same corner layout as Box.corners()
+        width, height = driver.robot_width, driver.robot_height
+        self.half_diagonal = np.sqrt(width**2 + height**2) / 2
+        base_angle = np.degrees(np.arctan2(height, width))
+        # front_right, front_left, back_left, back_right
+        self.corner_angles = np.array([360 - base_angle, base_angle, 180 - base_angle, 180 + base_angle])
+
+    def motors(self, left, right, seconds):
+        """Apply power to every robot's motors for a duration
+
+        left, right and seconds can each be a single value for all robots or
+        an array with one value per robot.
+        """
+        left = np.broadcast_to(left, (self.n,))
+        right = np.broadcast_to(right, (self.n,))
+        num_frames = np.broadcast_to(np.round(np.asarray(seconds) * self.fps).astype(int), (self.n,))
+
+        turn, forward = self._frame_deltas(left, right)
+        turning = turn != 0
+        for frame in range(num_frames.max(initial=0)):
+            active = (frame < num_frames) & ~self.crashed
+            self.heading = np.where(active & turning, (self.heading + turn) % 360, self.heading)
+            moving = active & (forward != 0)
+            self.x = np.where(moving, self.x + forward * cos(self.heading), self.x)
+            self.y = np.where(moving, self.y + forward * sin(self.heading), self.y)
+            self.crashed |= active & self._detect_crash()
+
+    def _frame_deltas(self, left, right):
+        """Per-robot (turn, forward) arrays, using SimulatorDriver's motion table"""
+        turn = np.zeros(self.n)
+        forward = np.zeros(self.n)
+        pairs, which = np.unique(np.stack([left, right], axis=1), axis=0, return_inverse=True)
+        which = which.reshape(-1)
+        for i, (pair_left, pair_right) in enumerate(pairs):
+            turn[which == i], forward[which == i] = self.driver._frame_deltas(pair_left, pair_right)
+        return turn, forward
+
+    def corners(self):
+        """Get every robot's corners
+
+        Returns: (corners_x, corners_y), each shaped (n, 4) with columns
+        front_right, front_left, back_left, back_right
+        """
+        angles = self.heading[:, None] + self.corner_angles
+        corners_x = self.x[:, None] + np.round(self.half_diagonal * cos(angles))
+        corners_y = self.y[:, None] + np.round(self.half_diagonal * sin(angles))
+        return corners_x, corners_y
+
+    def _detect_crash(self):
+        """Check which robots have a corner outside the arena"""
+        corners_x, corners_y = self.corners()
+        driver = self.driver
+        xcrash = (corners_x > driver.max_x_box) | (corners_x < driver.min_x_box)
+        ycrash = (corners_y > driver.max_y_box) | (corners_y < driver.min_y_box)
+        return (xcrash | ycrash).any(axis=1)
+
+    def _get_sonar_positions(self):
+        """Calculate the world positions of every robot's left and right sonars"""
+        corners_x, corners_y = self.corners()
+        front_right_x, front_left_x = corners_x[:, 0], corners_x[:, 1]
+        front_right_y, front_left_y = corners_y[:, 0], corners_y[:, 1]
+
+        edge_theta = np.degrees(np.arctan2(front_right_y - front_left_y, front_right_x - front_left_x))
+        inset = self.driver.sonar_inset
+        left_x = front_left_x + np.round(inset * cos(edge_theta))
+        left_y = front_left_y + np.round(inset * sin(edge_theta))
+        right_x = front_right_x + np.round(inset * cos(edge_theta + 180))
+        right_y = front_right_y + np.round(inset * sin(edge_theta + 180))
+        return (left_x, left_y), (right_x, right_y)
+
+    def dist_to_box(self, sonar_x, sonar_y):
+        """Distance from each sonar position to the nearest wall along the robot's heading"""
+        driver = self.driver
+        h = self.heading
+        N = driver.box_height / 2 - sonar_y
+        S = sonar_y + driver.box_height / 2
+        W = sonar_x + driver.box_width / 2
+        E = driver.box_width / 2 - sonar_x
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dist_to_horizontal = np.where(sin(h) > 0, N / sin(h), S / -sin(h))
+            dist_to_vertical = np.where(cos(h) > 0, E / cos(h), W / -cos(h))
+            general = np.minimum(dist_to_horizontal, dist_to_vertical)
+        # Cardinal directions are handled directly, like SimulatorDriver.dist_to_box
+        return np.select([h == 0, h == 90, h == 180, h == 270], [E, N, W, S], general)
+
+    def sonars(self):
+        """Get every robot's left and right sonar distances in centimeters (cm)
+
+        Returns: (left, right) arrays of length n
+        """
+        (left_x, left_y), (right_x, right_y) = self._get_sonar_positions()
+        return self.dist_to_box(left_x, left_y) / 10, self.dist_to_box(right_x, right_y) / 10
+
+
+def create_robot(mode=None, n_obstacles=None, randomize_obstacles=None):
+    """Make a Robot that drives the real robot or the simulator
+
+    Parameters:
+    * mode: "real" (or "r"), "sim" (or "s"), "headless" (simulator without
+      a window, as fast as possible) or "challenge" (simulator with
+      obstacles). If None, the ROBOT_MODE environment variable is used,
+      and if that isn't set either, you're asked.
+    * n_obstacles: how many obstacles the simulator has (the
+      ROBOT_OBSTACLES environment variable if None)
+    * randomize_obstacles: put the obstacles in random places (the
+      ROBOT_RANDOM_OBSTACLES environment variable, y or n, if None)
+
+    If the ROBOT_RECORD environment variable is set, the session is
+    recorded to that file (see Robot.start_recording). On the real robot,
+    ROBOT_TELEMETRY saves the timing of every motor and sonar pin change
+    to that file when the robot exits (see telemetry.py).
+
+    Example:
+        from simulator import create_robot
+        robot = create_robot("headless")
+    """
+    robot = _create_robot(mode, n_obstacles, randomize_obstacles)
+    if os.environ.get("ROBOT_RECORD"):
+        robot.start_recording(os.environ["ROBOT_RECORD"])
+    return robot
+
+def _create_robot(mode, n_obstacles, randomize_obstacles):
+    if mode is None:
+        mode = os.environ.get("ROBOT_MODE")
+    if n_obstacles is None and os.environ.get("ROBOT_OBSTACLES"):
+        n_obstacles = int(os.environ["ROBOT_OBSTACLES"])
+    if randomize_obstacles is None and os.environ.get("ROBOT_RANDOM_OBSTACLES"):
+        randomize_obstacles = os.environ["ROBOT_RANDOM_OBSTACLES"].lower() == 'y'
+
+    while True:
+        if mode is None:
+            mode = input("Do you want to run the real robot (r) or the simulator (s)?")
+        if mode in ("r", "real"):
+            return Robot(use_simulator=False)
+        elif mode in ("s", "sim"):
+            return Robot(use_simulator=True, n_obstacles=n_obstacles, randomize_obstacles=randomize_obstacles)
+        elif mode == "headless":
+            return Robot(use_simulator=True, n_obstacles=n_obstacles, randomize_obstacles=randomize_obstacles,
+                         headless=True)
+        elif mode == "challenge":
+            print("*** Simulator settings:")
+            if n_obstacles is None:
+                n_obstacles = int(input("*** How many obstacles? (0-3): "))
+            if randomize_obstacles is None:
+                randomize_obstacles = input("*** Randomize obstacle positions? (y/n): ").lower() == 'y'
+            print(f"Starting simulation with {n_obstacles} obstacles...")
+            return Robot(use_simulator=True, n_obstacles=n_obstacles, randomize_obstacles=randomize_obstacles)
+        else:
+            print("Please choose 'r' or 's'")
+            mode = None
+
+def __getattr__(name):
+    # `from simulator import robot` makes the robot the first time it's
+    # asked for, so importing anything else from here doesn't start one
+    if name == "robot":
+        global robot
+        robot = create_robot()
+        return robot
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if debug:
     if mode == "movement":
         robot = Robot(use_simulator=True)
@@ -686,23 +1978,3 @@ if debug:
             robot.motors(1, 1, 2)
         if command == "ll":
             robot.motors(1, -1, 2)
-else:
-    while True:
-        mode = input("Do you want to run the real robot (r) or the simulator (s)?")
-        if mode == "r":
-            from robot import RealRobotDriver
-            robot = Robot(use_simulator=False)
-            break
-        elif mode == "s":
-            robot = Robot(use_simulator=True)
-            break
-        elif mode == "challenge":
-            print("*** Simulator settings:")
-            n = int(input("*** How many obstacles? (0-3): "))
-            is_random = input("*** Randomize obstacle positions? (y/n): ").lower() == 'y'
-            print(f"Starting simulation with {n} obstacles...")
-            robot = Robot(use_simulator=True, n_obstacles=n, randomize_obstacles=is_random)
-            break
-        else:
-            print("Please choose 'r' or 's'")
-            
\ No newline at end of file
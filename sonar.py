@@ -0,0 +1,263 @@
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import deque
+
+class SonarSampler:
+    """Pings the left and right sonars in turn on a background thread
+
+    Every reading is stored with its timestamp in a ring buffer (a deque with
+    a maximum length) for each side. Appending to and reading from a deque
+    are atomic, so callers get the freshest reading without waiting for a
+    ping and without any locking. Each side also counts its readings, so
+    since() can hand over just the new ones (that takes a short lock, to
+    keep the count in step with the buffer). While it runs, all reads should go through
+    read(), so nothing else pings the sonars at the same time.
+
+    If a ping raises, the sampler stops and read() and latest() raise the
+    error in the caller's thread.
+
+    Parameters:
+    * read_left, read_right: functions that ping one sonar and return its distance
+    * rate: pings per second (the two sides take turns, so each side gets rate / 2)
+    * history: how many readings to keep for each side
+    * clock: function returning the time in seconds
+    """
+
+    def __init__(self, read_left, read_right, rate=20, history=100, clock=time.perf_counter):
+        self.ping = {'left': read_left, 'right': read_right}
+        self.rate = rate
+        self.clock = clock
+        self.readings = {'left': deque(maxlen=history), 'right': deque(maxlen=history)}
+        self.ready = {'left': threading.Event(), 'right': threading.Event()}
+        self.counts = {'left': 0, 'right': 0}  # readings taken so far, including ones pushed out
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        """Start pinging on a background thread"""
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.error = None
+        for side, ready in self.ready.items():
+            if not self.readings[side]:
+                ready.clear()
+        self.thread = threading.Thread(target=self._run, name="sonar sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop pinging and wait for the background thread to finish"""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        try:
+            self._ping_forever()
+        except Exception as error:
+            self.error = error
+        finally:
+            # Nobody waits for a reading that isn't coming
+            for ready in self.ready.values():
+                ready.set()
+
+    def _ping_forever(self):
+        interval = 1 / self.rate
+        next_ping = self.clock()
+        side = 'left'
+        while not self.stopping.is_set():
+            distance = self.ping[side]()
+            with self.lock:
+                self.readings[side].append((self.clock(), distance))
+                self.counts[side] += 1
+            self.ready[side].set()
+            side = 'right' if side == 'left' else 'left'
+
+            # Ping on a fixed schedule, so slow pings don't make the rate drift
+            next_ping += interval
+            delay = next_ping - self.clock()
+            if delay < 0:
+                next_ping = self.clock()
+            elif self.stopping.wait(delay):
+                break
+
+    def read(self, side):
+        """Get the freshest distance for 'left' or 'right', waiting for the first ping if needed
+
+        Returns None if the sampler stopped before pinging that side.
+        """
+        self.ready[side].wait()
+        return self.latest(side)
+
+    def latest(self, side):
+        """Get the freshest distance for 'left' or 'right', or None if there isn't one yet"""
+        if self.error is not None:
+            raise Exception(f"Ooops! Dr. Ebee's sonar sampler stopped: {self.error!r}") from self.error
+        readings = self.readings[side]
+        try:
+            return readings[-1][1]
+        except IndexError:
+            return None
+
+    def since(self, side, count):
+        """Get the readings for 'left' or 'right' after the first `count`, oldest first
+
+        Costs as much as the number of new readings, however long the
+        history is. Readings that were pushed out of the history are lost.
+
+        Returns: (list of (timestamp, distance), count to pass next time)
+        """
+        with self.lock:
+            readings = self.readings[side]
+            total = self.counts[side]
+            new = len(readings) if count > total else min(total - count, len(readings))
+            return [readings[i] for i in range(len(readings) - new, len(readings))], total
+
+    def history(self, side, n=None):
+        """Get the last n (timestamp, distance) readings for 'left' or 'right', oldest first"""
+        readings = list(self.readings[side])
+        if n is not None:
+            readings = readings[-n:] if n > 0 else []
+        return readings
+
+# Sonar filters
+#
+# Each filter takes the raw readings from one sonar one at a time, and has:
+# * update(distance): add a new reading and return the filtered distance
+# * predict(change): tell the filter the distance just changed by `change`
+#   cm because the robot moved (None if the change is unknown, e.g. after a
+#   turn, which makes the filter start over)
+# * reset(): forget everything
+# Every update and predict costs the same no matter how long the filter has run.
+
+class MedianFilter:
+    """Median of the last k readings, which ignores the odd wild reading"""
+
+    def __init__(self, k=5):
+        self.k = k
+        self.reset()
+
+    def reset(self):
+        self.window = deque()
+        self.ordered = []
+
+    def update(self, distance):
+        if len(self.window) == self.k:
+            oldest = self.window.popleft()
+            del self.ordered[bisect_left(self.ordered, oldest)]
+        self.window.append(distance)
+        insort(self.ordered, distance)
+        return self.value()
+
+    def value(self):
+        n = len(self.ordered)
+        if n == 0:
+            return None
+        if n % 2 == 1:
+            return self.ordered[n // 2]
+        return (self.ordered[n // 2 - 1] + self.ordered[n // 2]) / 2
+
+    def predict(self, change):
+        if change is None:
+            self.reset()
+            return
+        # Every stored reading moves by the same amount, so their order doesn't change
+        self.window = deque(distance + change for distance in self.window)
+        self.ordered = [distance + change for distance in self.ordered]
+
+class ExponentialFilter:
+    """Exponential smoothing: each reading moves the estimate `alpha` of the way towards it
+
+    Readings of infinity (no echo) are skipped, so they don't wipe out the estimate.
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.estimate = None
+
+    def update(self, distance):
+        if not math.isfinite(distance):
+            return distance if self.estimate is None else self.estimate
+        if self.estimate is None:
+            self.estimate = distance
+        else:
+            self.estimate += self.alpha * (distance - self.estimate)
+        return self.estimate
+
+    def predict(self, change):
+        if change is None:
+            self.reset()
+        elif self.estimate is not None:
+            self.estimate += change
+
+class KalmanFilter:
+    """1-D Kalman filter for the distance to whatever the sonar is pointing at
+
+    The estimate moves with the robot's commanded motion (predict), and each
+    reading pulls it towards the measurement by how much the filter trusts
+    the reading compared to its own estimate.
+
+    Parameters:
+    * measurement_noise: variance of a single reading (cm^2)
+    * process_noise: variance added between readings, for things the filter can't predict (cm^2)
+    * motion_noise: extra standard deviation per cm of commanded motion (wheels slip)
+    """
+
+    def __init__(self, measurement_noise=1.0, process_noise=0.05, motion_noise=0.1):
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.motion_noise = motion_noise
+        self.reset()
+
+    def reset(self):
+        self.estimate = None
+        self.variance = None
+
+    def update(self, distance):
+        if not math.isfinite(distance):
+            return distance if self.estimate is None else self.estimate
+        if self.estimate is None:
+            self.estimate = distance
+            self.variance = self.measurement_noise
+            return self.estimate
+
+        self.variance += self.process_noise
+        gain = self.variance / (self.variance + self.measurement_noise)
+        self.estimate += gain * (distance - self.estimate)
+        self.variance *= 1 - gain
+        return self.estimate
+
+    def predict(self, change):
+        if change is None:
+            self.reset()
+        elif self.estimate is not None:
+            self.estimate += change
+            self.variance += (self.motion_noise * change) ** 2
+
+class FilterChain:
+    """Runs readings through several filters in order, e.g. FilterChain(MedianFilter(3), KalmanFilter())"""
+
+    def __init__(self, *filters):
+        self.filters = filters
+
+    def reset(self):
+        for sonar_filter in self.filters:
+            sonar_filter.reset()
+
+    def update(self, distance):
+        for sonar_filter in self.filters:
+            distance = sonar_filter.update(distance)
+        return distance
+
+    def predict(self, change):
+        for sonar_filter in self.filters:
+            sonar_filter.predict(change)
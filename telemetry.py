@@ -0,0 +1,191 @@
+import argparse
+import itertools
+import json
+import math
+import time
+from array import array
+
+import numpy as np
+
+# Kinds of GPIO event, stored as one byte each
+MOTOR_ON = 0       # motor pins set to a new power (value = commanded seconds, nan if open-ended)
+MOTOR_OFF = 1      # motor pins switched off
+SONAR_TRIGGER = 2  # trigger pulse sent (channel = echo pin)
+ECHO_RISE = 3      # echo pin went high
+ECHO_FALL = 4      # echo pin went low
+SONAR_TIMEOUT = 5  # no echo before the timeout
+
+EVENT_NAMES = {
+    MOTOR_ON: "motor_on",
+    MOTOR_OFF: "motor_off",
+    SONAR_TRIGGER: "sonar_trigger",
+    ECHO_RISE: "echo_rise",
+    ECHO_FALL: "echo_fall",
+    SONAR_TIMEOUT: "sonar_timeout",
+}
+EVENT_KINDS = {name: kind for kind, name in EVENT_NAMES.items()}
+
+class GpioTelemetry:
+    """Timestamps of GPIO edges, kept in preallocated arrays
+
+    Every event is four numbers in four arrays of `capacity` entries made up
+    front, so recording one never allocates: the time from
+    time.perf_counter_ns(), the kind (MOTOR_ON etc.), the pin and a value.
+    Once the arrays are full the oldest events are overwritten. Events come
+    from the main thread, the stop timer and the GPIO interrupt thread, so
+    each one takes its slot from a shared counter instead of a lock.
+
+    Parameters:
+    * capacity: how many events to keep
+    * path: file that RealRobotDriver.exit() saves the events to (see save())
+
+    Example:
+    telemetry = GpioTelemetry()
+    driver = RealRobotDriver(telemetry=telemetry)
+    driver.motors(1, -1, 0.5)
+    print(summarize(telemetry.events()))
+    """
+
+    def __init__(self, capacity=8192, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.times = array('q', bytes(8 * capacity))
+        self.kinds = array('b', bytes(capacity))
+        self.channels = array('b', bytes(capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.counter = itertools.count()
+        self.count = 0
+
+    def record(self, kind, channel=0, value=0.0):
+        number = next(self.counter)
+        slot = number % self.capacity
+        self.times[slot] = time.perf_counter_ns()
+        self.kinds[slot] = kind
+        self.channels[slot] = channel
+        self.values[slot] = value
+        self.count = max(self.count, number + 1)
+
+    def events(self):
+        """Recorded events, oldest first, as (time ns, kind, channel, value) tuples"""
+        count = self.count
+        if count <= self.capacity:
+            slots = range(count)
+        else:
+            start = count % self.capacity
+            slots = itertools.chain(range(start, self.capacity), range(start))
+        events = [(self.times[i], self.kinds[i], self.channels[i], self.values[i]) for i in slots]
+        # Threads can finish writing slightly out of order
+        events.sort()
+        return events
+
+    def save(self, path=None):
+        """Write the events to a JSON-lines file, one event per line"""
+        with open(path or self.path, "w") as file:
+            for time_ns, kind, channel, value in self.events():
+                line = {"t_ns": time_ns, "event": EVENT_NAMES[kind], "channel": channel,
+                        "value": None if math.isnan(value) else value}
+                file.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+def load_telemetry(path):
+    """Read events saved by GpioTelemetry.save()"""
+    events = []
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                event = json.loads(line)
+                value = math.nan if event["value"] is None else event["value"]
+                events.append((event["t_ns"], EVENT_KINDS[event["event"]], event["channel"], value))
+    return events
+
+def distribution(milliseconds):
+    """count, mean, p50, p95 and max of a list of milliseconds"""
+    if not milliseconds:
+        return {"count": 0}
+    values = np.array(milliseconds)
+    p50, p95 = np.percentile(values, (50, 95))
+    return {"count": len(values), "mean": float(values.mean()), "p50": float(p50),
+            "p95": float(p95), "max": float(values.max())}
+
+def summarize(events):
+    """Commanded vs actual motor-on times, and sonar latencies, in milliseconds
+
+    A motor command lasts from its MOTOR_ON edge to the next motor edge (on
+    or off). A sonar reading's round trip is from the trigger to the end of
+    the echo, and its start delay is from the trigger to the echo rising.
+
+    Returns: dict with "motor" (a distribution of the errors, actual minus
+    commanded, plus every (commanded, actual) pair) and "sonar" (a
+    "round_trip" and "start_delay" distribution and "timeouts" per echo pin)
+    """
+    commands = []
+    running = None  # (time, commanded seconds) of the last MOTOR_ON
+    triggers = {}  # echo pin -> [time of the trigger waiting for its echo, whether the echo has started]
+    sonar = {}
+    for time_ns, kind, channel, value in events:
+        if kind in (MOTOR_ON, MOTOR_OFF):
+            if running is not None and not math.isnan(running[1]):
+                actual = (time_ns - running[0]) / 1e6
+                commands.append((running[1] * 1000, actual))
+            running = (time_ns, value) if kind == MOTOR_ON else None
+            continue
+
+        pin = sonar.setdefault(channel, {"round_trip": [], "start_delay": [], "timeouts": 0})
+        if kind == SONAR_TRIGGER:
+            triggers[channel] = [time_ns, False]
+        elif channel not in triggers:
+            continue  # echo with no trigger waiting for it (or from before the first one kept)
+        elif kind == ECHO_RISE:
+            if not triggers[channel][1]:
+                triggers[channel][1] = True
+                pin["start_delay"].append((time_ns - triggers[channel][0]) / 1e6)
+        elif kind == ECHO_FALL:
+            pin["round_trip"].append((time_ns - triggers.pop(channel)[0]) / 1e6)
+        elif kind == SONAR_TIMEOUT:
+            del triggers[channel]
+            pin["timeouts"] += 1
+
+    return {
+        "motor": {
+            "error": distribution([actual - commanded for commanded, actual in commands]),
+            "commands": commands,
+        },
+        "sonar": {
+            channel: {"round_trip": distribution(pin["round_trip"]),
+                      "start_delay": distribution(pin["start_delay"]),
+                      "timeouts": pin["timeouts"]}
+            for channel, pin in sonar.items()
+        },
+    }
+
+def print_summary(summary):
+    def line(name, stats):
+        if stats["count"] == 0:
+            print(f"  {name:22} none")
+        else:
+            print(f"  {name:22} n={stats['count']:<5} mean {stats['mean']:8.3f}  p50 {stats['p50']:8.3f}  "
+                  f"p95 {stats['p95']:8.3f}  max {stats['max']:8.3f} ms")
+
+    print("Motors (actual - commanded on time):")
+    line("error", summary["motor"]["error"])
+    for commanded, actual in summary["motor"]["commands"][-10:]:
+        print(f"    commanded {commanded:9.3f} ms, ran {actual:9.3f} ms")
+    for channel, pin in summary["sonar"].items():
+        print(f"Sonar (echo pin {channel}), {pin['timeouts']} timeouts:")
+        line("trigger to echo end", pin["round_trip"])
+        line("trigger to echo start", pin["start_delay"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize GPIO telemetry saved by the real robot")
+    parser.add_argument("path", help="telemetry file (see ROBOT_TELEMETRY)")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = summarize(load_telemetry(args.path))
+    if args.json:
+        print(json.dumps(summary, indent=2, default=str))
+    else:
+        print_summary(summary)
+    return summary
+
+if __name__ == "__main__":
+    main()